@@ -0,0 +1,128 @@
+import sys
+import json
+import time
+import argparse
+import platform
+from itertools import islice
+
+import numpy as np
+import cv2
+
+from perception import color_thresh, perspect_transform, rover_coords, to_polar_coords, pix_to_world, \
+    perception_step, CALIBRATION_SOURCE, CAMERA_SHAPE, destination_points
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images
+from replay import read_log, telemetry_message
+from drive_rover import RoverState
+from events import QUIET
+
+# Micro-benchmarks of every stage of the pipeline, on the frames of the test dataset.
+# Run from the code folder:
+# $ python benchmark.py --save benchmark_baseline.json     (record a baseline)
+# $ python benchmark.py --compare benchmark_baseline.json  (fail if a stage is slower than the baseline by more than --tolerance)
+
+DATASETS = {'IMG': ('../test_dataset/robot_log.csv', None),
+            'dummy-video-frames': ('../test_dataset/robot_log.csv', '../test_dataset/dummy-video-frames')}
+
+# Define a function to build the telemetry messages the simulator would send for the frames of a dataset
+def load_telemetry(log, images=None, max_frames=None):
+    frames = islice(read_log(log, images), max_frames)
+    return [telemetry_message(frame) for frame in frames]
+
+# Define a class collecting the duration of the calls of each stage
+class StageTimer():
+    def __init__(self):
+        self.durations = {}
+
+    # Call func(*args), record its duration under `stage` and return its result
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        summary = {}
+        for stage, durations in self.durations.items():
+            durations = np.array(durations) * 1e6
+            summary[stage] = {'median_us': float(np.median(durations)),
+                              'p95_us': float(np.percentile(durations, 95)),
+                              'calls': len(durations)}
+        return summary
+
+# Define a function to run the benchmarks on the telemetry messages of a dataset
+def run_dataset(timer, messages, rounds):
+    src = CALIBRATION_SOURCE
+    dst = destination_points(CAMERA_SHAPE)
+    for _ in range(rounds):
+        Rover = RoverState()
+        # Measure the full cost of the insets on every frame.
+        Rover.map_inset.max_rate = Rover.vision_inset.max_rate = None
+        Rover.events.console_level = QUIET
+        for data in messages:
+            # Whole steps, in the order of the telemetry handler
+            Rover, _ = timer.time('update_rover', update_rover, Rover, data)
+            Rover = timer.time('perception_step', perception_step, Rover)
+            Rover = timer.time('decision_step', decision_step, Rover)
+            timer.time('create_output_images', create_output_images, Rover)
+
+            # Individual perception functions
+            warped = timer.time('perspect_transform', perspect_transform, Rover.img, src, dst)
+            threshed = timer.time('color_thresh', color_thresh, warped, (190, 180, 165), (255, 255, 230))
+            xpix, ypix = timer.time('rover_coords', rover_coords, threshed)
+            timer.time('to_polar_coords', to_polar_coords, xpix, ypix)
+            timer.time('pix_to_world', pix_to_world, xpix, ypix, Rover.pos[0], Rover.pos[1], Rover.yaw,
+                       Rover.worldmap.shape[0], 10)
+
+# Define a function to compare results with a baseline, returns the list of regressions
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, stats in results.items():
+        if key not in baseline:
+            continue
+        base, current = baseline[key]['median_us'], stats['median_us']
+        if current > base * (1 + tolerance):
+            regressions.append((key, base, current))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the rover pipeline')
+    parser.add_argument('--frames', type=int, default=None, help='Maximum number of frames of each dataset.')
+    parser.add_argument('--rounds', type=int, default=3, help='Number of passes over the frames.')
+    parser.add_argument('--save', type=str, default='', help='Save the results as a JSON baseline.')
+    parser.add_argument('--compare', type=str, default='', help='JSON baseline to compare the results with.')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Maximum allowed slowdown of a stage median compared to the baseline (0.25 => 25%%).')
+    args = parser.parse_args()
+
+    results = {}
+    for name, (log, images) in DATASETS.items():
+        timer = StageTimer()
+        run_dataset(timer, load_telemetry(log, images, args.frames), args.rounds)
+        for stage, stats in timer.summary().items():
+            results['{}/{}'.format(name, stage)] = stats
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['stages']
+
+    print('{:<45} {:>12} {:>12} {:>12}'.format('stage', 'median (us)', 'p95 (us)', 'baseline'))
+    for key, stats in results.items():
+        base = '{:.1f}'.format(baseline[key]['median_us']) if key in baseline else '-'
+        print('{:<45} {:>12.1f} {:>12.1f} {:>12}'.format(key, stats['median_us'], stats['p95_us'], base))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'platform': platform.platform(), 'python': platform.python_version(),
+                       'numpy': np.__version__, 'opencv': cv2.__version__,
+                       'frames': args.frames, 'rounds': args.rounds, 'stages': results}, baseline_file, indent=2)
+        print("Saved results to {}".format(args.save))
+
+    if args.compare:
+        regressions = compare(results, baseline, args.tolerance)
+        for key, base, current in regressions:
+            print("REGRESSION {}: {:.1f} us -> {:.1f} us (+{:.0f}%)".format(key, base, current, 100 * (current / base - 1)))
+        if regressions:
+            sys.exit(1)
+        print("No stage regressed by more than {:.0f}%".format(100 * args.tolerance))
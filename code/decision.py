@@ -1,6 +1,8 @@
 import numpy as np
 import time
 
+import events
+
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
 def decision_step(Rover):
@@ -9,11 +11,14 @@ def decision_step(Rover):
     # => Other special states like ['sample detected', 'stuck in a loop', 'stuck by an obstacle', etc...]
     # We can divide this function into two parts, one for dealing the with the special states, and another for dealing with the normal states.
     
+    # Record the pose of the rover, the loops and stuck situations are detected from its recent motion.
+    Rover.history.add(Rover.pos[0], Rover.pos[1], Rover.yaw)
+    
     ## 1. Dealing with special events. Comes first because dealing with special events has higher priority than dealing with normal events.
     # <<== Start of `Handling samples` ==>>
     # If we are near a rock sample, stop all types of movements and send a pickup command.
     if Rover.near_sample:
-        print(f"\rNear a sample! {Rover.iteration_counter}\r", end="")
+        Rover.events.log(events.NEAR_SAMPLE, Rover)
         # Rover.mode = "stop"
         Rover.brake = Rover.brake_set
         Rover.throttle = 0
@@ -23,7 +28,7 @@ def decision_step(Rover):
             Rover.samples_collected += 1
             Rover.rock_detected = False
             Rover.mode = "picked-sample"
-            print("")
+            Rover.events.log(events.PICKUP, Rover)
         return Rover
     
     # <<== End of `Handling samples` ==>>
@@ -35,7 +40,7 @@ def decision_step(Rover):
     # Handling when the car is stuck by some obstacle.
     if Rover.mode == 'stuck':
         if Rover.stuck_mode == 'forward':
-            print(f"\rStuck by some nasty obstacle! Performing 'forward' action. {Rover.iteration_counter}\r", end="")
+            Rover.events.log(events.STUCK_ACTION, Rover)
             Rover.throttle = 1
             # Rover.steer = 0
             Rover.brake = 0
@@ -43,8 +48,8 @@ def decision_step(Rover):
             
             # If the car is still stuck, repeat again from just moving.
             if Rover.stuck_counter >= 50:
-                print("")
                 Rover.stuck_mode = 'steer'
+                Rover.events.log(events.STUCK_NEXT_ACTION, Rover)
                 Rover.throttle = 0
                 Rover.brake = 0
                 # if Rover.nav_angles is not None and len(Rover.nav_angles):
@@ -54,22 +59,22 @@ def decision_step(Rover):
                 Rover.stuck_counter = 0
         
         elif Rover.stuck_mode == 'steer':
-            print(f"\rStuck by some obstacle! Performing 'steer' action. {Rover.iteration_counter}\r", end="")
+            Rover.events.log(events.STUCK_ACTION, Rover)
             Rover.throttle = 0
             Rover.brake = 0
             Rover.stuck_counter += 1
             
             # If the car is still stuck, change to moving and steering.
             if Rover.stuck_counter >= 40:
-                print("")
                 Rover.stuck_mode = 'forward2'
+                Rover.events.log(events.STUCK_NEXT_ACTION, Rover)
                 Rover.throttle = 1
-                Rover.steer = np.sign(np.mean(Rover.nav_angles * 180/np.pi))*15
+                Rover.steer = np.sign(Rover.nav_hist.mean())*15
                 Rover.brake = 0
                 Rover.stuck_counter = 0
         
         elif Rover.stuck_mode == 'forward2':
-            print(f"\rStuck by some nasty obstacle! Performing 'forward2' action. {Rover.iteration_counter}\r", end="")
+            Rover.events.log(events.STUCK_ACTION, Rover)
             Rover.throttle = 1
             # Rover.steer = 0
             Rover.brake = 0
@@ -77,25 +82,25 @@ def decision_step(Rover):
             
             # If the car is still stuck, repeat again from just moving.
             if Rover.stuck_counter >= 30:
-                print("")
                 Rover.stuck_mode = 'backward'
+                Rover.events.log(events.STUCK_NEXT_ACTION, Rover)
                 Rover.throttle = -1
                 Rover.brake = 0
-                Rover.steer = np.sign(np.mean(Rover.nav_angles * 180/np.pi))*15
+                Rover.steer = np.sign(Rover.nav_hist.mean())*15
                 Rover.stuck_counter = 0
         
         elif Rover.stuck_mode == 'backward':
-            print(f"\rStuck by some obstacle! Performing 'backward' action. {Rover.iteration_counter}\r", end="")
+            Rover.events.log(events.STUCK_ACTION, Rover)
             Rover.throttle = -1
             Rover.stuck_counter += 1
             
             # If the car is still stuck, change from moving to steering.
             # Two seconds is too long and causes the car to become stuck again.
             if Rover.stuck_counter >= 40:
-                print("")
                 Rover.stuck_mode = 'forward'
+                Rover.events.log(events.STUCK_NEXT_ACTION, Rover)
                 Rover.throttle = 1
-                Rover.steer = np.sign(np.mean(Rover.nav_angles * 180/np.pi))*15
+                Rover.steer = np.sign(Rover.nav_hist.mean())*15
                 Rover.stuck_counter = 0
                 Rover.brake = 0
         
@@ -106,9 +111,10 @@ def decision_step(Rover):
         
         # If we gain enough speed, then we are finally out of stuck.
         if Rover.stuck_speed_counter > 10:
-            print("\nBroke out of the stuck position.")
             Rover.mode = 'forward'
             Rover.stuck_mode = ''
+            Rover.events.log(events.UNSTUCK, Rover)
+            Rover.history.reset()
             Rover.throttle = Rover.throttle_set
             Rover.steer = 0
             Rover.brake = 0
@@ -120,14 +126,16 @@ def decision_step(Rover):
         return Rover
     
     # Checking if the car is stuck by some obstacle while moving.
-    if Rover.mode == 'forward' and Rover.vel <= 0.25:
+    if Rover.mode == 'forward':
         Rover.stuck_counter += 1
         
-        # If the car is stuck for 2 seconds, then it is in a 'stuck' state.
-        if Rover.stuck_counter >= 120:
-            print("")
+        # If the car has been in forward mode for 90 frames and moved less than half a meter away
+        # from where it was 90 frames ago, then it is in a 'stuck' state (whatever its reported speed).
+        if Rover.stuck_counter >= 90 and Rover.history.stuck(90):
             Rover.mode = 'stuck'
             Rover.stuck_mode = 'steer'
+            Rover.events.log(events.STUCK, Rover, Rover.history.displacement(90), 90)
+            Rover.history.reset()
             Rover.throttle = 0
             Rover.brake = 0
             # Rover.steer = 0
@@ -146,18 +154,18 @@ def decision_step(Rover):
         Rover.brake = 0
         if Rover.picked_sample_counter <= 50:
             Rover.picked_sample_counter += 1
-            print(f"\rReturning back some distance. {Rover.iteration_counter}\r", end="")
+            Rover.events.log(events.RETURNING, Rover)
             Rover.throttle = -Rover.throttle_set
             return Rover
         
-        print("")
+        Rover.events.log(events.RETURNED, Rover)
         Rover.picked_sample_counter = 0
         Rover.throttle = Rover.throttle_set
         
         if abs(Rover.vel) >= 0.3:
             Rover.mode = 'forward'
-        elif Rover.nav_angles is not None and len(Rover.nav_angles):
-            Rover.steer = np.sign(np.mean(Rover.nav_angles * 180/np.pi))*15 # Steer left/right (+ve/-ve).
+        elif Rover.nav_hist is not None and Rover.nav_hist.count:
+            Rover.steer = np.sign(Rover.nav_hist.mean())*15 # Steer left/right (+ve/-ve).
         else:
             Rover.steer = -15
     
@@ -166,32 +174,27 @@ def decision_step(Rover):
     # <<== Start of `Handling loops` ==>>
     if Rover.mode == "loop":
         # Stop steering, keep moving for two seconds, then exit the loop state.
-        print(f"\rStuck in a loop! Changing to moving forward. {Rover.iteration_counter}\r", end="")
+        Rover.events.log(events.LOOP_FORWARD, Rover)
         Rover.throttle = Rover.throttle_set
         Rover.steer = 0
         Rover.brake = 0
         Rover.loop_counter += 1
-        if len(Rover.rock_angles) > 0:
-            Rover.steer = np.clip(np.mean(np.sort(Rover.rock_angles)[int(len(Rover.rock_angles)/2):] * 180/np.pi), -15, 15)
+        if Rover.rock_hist.count > 0:
+            Rover.steer = np.clip(Rover.rock_hist.left_half_mean() * 180/np.pi, -15, 15)
         
         if Rover.loop_counter >= 50:
-            print("")
             Rover.mode = 'forward'
             Rover.loop_counter = 0
+            Rover.events.log(events.LOOP_END, Rover)
+            Rover.history.reset()
         return Rover
     
-    # Keeping track of how much we have been moving left/right to break loops.
-    if abs(Rover.steer) >= 7: # and not (Rover.rock_detected and Rover.vel == 0)
-        Rover.steering_counter += 1
-        
-        # If the car is steering for 250 frames, then it is stuck in a loop.
-        if Rover.steering_counter >= 250:
-            print("")
-            Rover.mode = "loop"
-            Rover.steering_counter = 0
-            return Rover
-    else:
-        Rover.steering_counter = 0
+    # Checking if the car is driving in circles (a full turn within a few meters, or coming back to the same place over and over).
+    if Rover.history.looping():
+        Rover.mode = "loop"
+        Rover.events.log(events.LOOP, Rover, Rover.history.heading_drift(600), Rover.history.displacement(600))
+        Rover.history.reset()
+        return Rover
     
     # <<== End of `Handling loops` ==>>
     
@@ -199,13 +202,13 @@ def decision_step(Rover):
     # <<== Start of `Handling rock samples` ==>>
     # If a rock sample is identified, make sure that the velocity is low but not zero.
     # if len(np.abs(Rover.rock_angles) >= (5*np.pi/180)) > 0:
-    Rover.rock_detected = len(Rover.rock_angles) > 0
-    rock_angles_mid = int(len(Rover.rock_angles)/2)
-    print(f"\rNAs={len(Rover.nav_angles)}, SAs={len(Rover.rock_angles[rock_angles_mid:])}", end=" ")
+    Rover.rock_detected = Rover.rock_hist.count > 0
+    rock_angles_mid = int(Rover.rock_hist.count/2)
+    Rover.events.log(events.NAV_STATUS, Rover, Rover.nav_hist.count, Rover.rock_hist.count - rock_angles_mid)
     if Rover.rock_detected:
-        # Direct the car towards the target sample.
-        Rover.steer = np.clip(np.mean(np.sort(Rover.rock_angles)[rock_angles_mid:] * 180/np.pi), -15, 15)
-        print(f"| SAV={Rover.steer:0.2f}. {int(Rover.iteration_counter)}", end="")
+        # Direct the car towards the target sample (left half of its pixels).
+        Rover.steer = np.clip(Rover.rock_hist.left_half_mean() * 180/np.pi, -15, 15)
+        Rover.events.log(events.ROCK_STEER, Rover, Rover.steer)
         
         # Ensure enough speed until the car is within reach to a target sample.
         if Rover.vel <= 1:
@@ -237,13 +240,15 @@ def decision_step(Rover):
     
     
     ## 2. Dealing with normal events.
-    nav_agnels_len = len(Rover.nav_angles)
-    if Rover.nav_angles is not None and nav_agnels_len > 3:
+    nav_agnels_len = Rover.nav_hist.count
+    if Rover.nav_hist is not None and nav_agnels_len > 3:
         # One way to force the car to go to all the map locations is to always take the same direction (left or right).
         # If we want to force the car to always go to the left, can discard the angles directed to the right.
         # Check if we have vision data to make decisions with
-        nav_angles_mid = int(len(Rover.nav_angles)/2)
-        Rover.nav_angles = np.sort(Rover.nav_angles)[nav_angles_mid:]
+        # Steer towards the left half of the navigable terrain pixels (computed from the angular histogram).
+        nav_steer = np.clip(Rover.nav_hist.left_half_mean() * 180/np.pi, -15, 15)
+        # Lean towards the unexplored areas if an exploration planner is set
+        nav_steer = exploration_steer(Rover, nav_steer)
         
         # Completely discarding the angles directed to the right seems to have some downsides, so let's just take a small subset of them.
         # sorted_nav_angles = np.sort(Rover.nav_angles)
@@ -255,7 +260,7 @@ def decision_step(Rover):
         if Rover.mode == 'forward':
             # Check the extent of navigable terrain
             if nav_agnels_len >= Rover.stop_forward:  
-                print(f"Normal forward movement. {Rover.iteration_counter}\r", end="")
+                Rover.events.log(events.FORWARD, Rover)
                 
                 # If mode is forward, navigable terrain looks good and velocity is below max, then throttle.
                 if Rover.vel < Rover.max_vel:
@@ -266,24 +271,23 @@ def decision_step(Rover):
                 Rover.brake = 0
                 
                 # Set steering to average angle clipped to the range +/- 15
-                Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                Rover.steer = nav_steer
             
             # If there's a lack of navigable terrain pixels then go to 'stop' mode
             elif nav_agnels_len < Rover.stop_forward:
-                print("Dead end!")
-                
                 # Set mode to "stop" and hit the brakes!
                 Rover.throttle = 0
                 # Set brake to stored brake value
                 Rover.brake = Rover.brake_set
                 Rover.steer = 0
                 Rover.mode = 'stop'
+                Rover.events.log(events.DEAD_END, Rover)
         
         # If we're already in "stop" mode then make different decisions
         elif Rover.mode == 'stop':
             # If we're in stop mode but still moving keep braking
             if abs(Rover.vel) > 0.2:
-                print(f"Stopping... {Rover.iteration_counter}\r", end="")
+                Rover.events.log(events.STOPPING, Rover)
                 Rover.throttle = 0
                 Rover.brake = Rover.brake_set
                 Rover.steer = 0
@@ -292,15 +296,15 @@ def decision_step(Rover):
             elif Rover.vel <= 0.2:
                 # Since now we are in the stop mode, check if there is a nearby sample to collect (Not necessary as we have already dealt with this earlier).
                 if Rover.rock_detected:
-                    print(f"Approaching sample, adjusting speed... {Rover.iteration_counter}\r", end="")
+                    Rover.events.log(events.APPROACHING_SAMPLE, Rover)
                     # Move towards the rock sample. Don't exit the stop mode to ensure low velocity.
-                    Rover.steer = np.clip(np.mean(Rover.rock_angles * 180/np.pi), -15, 15)
+                    Rover.steer = np.clip(Rover.rock_hist.mean() * 180/np.pi, -15, 15)
                     Rover.throttle = Rover.throttle_set
                     Rover.brake = 0
                 
                 # Now we're stopped and we have vision data to see if there's a path forward
                 elif nav_agnels_len < Rover.go_forward:
-                    print(f"Stopped and can't go forward. {Rover.iteration_counter}\r", end="")
+                    Rover.events.log(events.STOPPED_BLOCKED, Rover)
                     # Release the brake to allow turning
                     Rover.brake = 0
                     Rover.throttle = 0 # Rover.throttle_set
@@ -320,14 +324,14 @@ def decision_step(Rover):
                 
                 # If we're stopped but see sufficient navigable terrain in front then go!
                 elif nav_agnels_len >= Rover.go_forward:
-                    print("\nStopped but can go forward.")
                     # Set throttle back to stored value
                     Rover.throttle = Rover.throttle_set
                     # Release the brake
                     Rover.brake = 0
                     # Set steer to mean angle
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
+                    Rover.steer = nav_steer
                     Rover.mode = 'forward'
+                    Rover.events.log(events.GO_FORWARD, Rover)
     
     # Just to make the rover do something 
     # even if no modifications have been made to the code
@@ -339,7 +343,7 @@ def decision_step(Rover):
         # Rover.throttle = 1
         # Rover.steer = 0
         
-        print(f"No enough angles data received: {nav_agnels_len} angles. Steering... ({Rover.iteration_counter})\r", end="")
+        Rover.events.log(events.NO_NAV_DATA, Rover, nav_agnels_len)
         Rover.throttle = 0
         # if Rover.nav_angles is not None and len(Rover.nav_angles):
         #     Rover.steer = np.sign(np.mean(Rover.nav_angles * 180/np.pi))*15 # Steer left/right (+ve/-ve).
@@ -356,3 +360,18 @@ def decision_step(Rover):
         # Rover.steer = 0
     
     return Rover
+
+# Define a function to steer towards the exploration heading of the planner (see FrontierPlanner), if any.
+# The heading (clipped to the steering range) is blended with nav_steer only when there is enough navigable
+# terrain in its direction on the current frame, since the worldmap doesn't know about what is right in front.
+def exploration_steer(Rover, nav_steer):
+    planner = Rover.planner
+    if planner is None or planner.heading is None:
+        return nav_steer
+    heading_steer = np.clip(planner.heading, -15, 15)
+    
+    # Navigable terrain pixels within 10 degrees of the heading
+    direction = heading_steer * np.pi/180
+    if Rover.nav_hist.count_between(direction - np.pi/18, direction + np.pi/18) < Rover.stop_forward:
+        return nav_steer
+    return np.clip((1 - planner.steer_weight) * nav_steer + planner.steer_weight * heading_steer, -15, 15)
@@ -10,17 +10,22 @@ import socketio
 import eventlet
 import eventlet.wsgi
 from PIL import Image
-from flask import Flask
+from flask import Flask, jsonify, request
 from io import BytesIO, StringIO
 import json
 import pickle
 import matplotlib.image as mpimg
 import time
 
-# Import functions for perception and decision making
-from perception import perception_step
-from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+# Import the rover state components and the sessions running the perception and decision steps
+from supporting_functions import InsetEncoder, FrameDecoder
+from worldmap import create_worldmap, MapStatistics
+from pipeline import FramePipeline
+from sessions import RoverSession, ShardPool, control_message
+from metrics import Metrics
+from events import EventLog, DEBUG, INFO, QUIET
+from history import PoseHistory
+from scheduler import DEGRADATIONS
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
@@ -34,14 +39,27 @@ ground_truth = mpimg.imread('../calibration_images/map_bw.png')
 # This next line creates arrays of zeros in the red and blue channels
 # and puts the map into the green channel.  This is why the underlying 
 # map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(float)
+# The map is only 0/255, so it is stored as uint8 and shared (read only) by all the rover states.
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.uint8)
+ground_truth_3d.setflags(write=False)
 
 # Define RoverState() class to retain rover state parameters
 class RoverState():
+    # Fixed set of attributes: no per-instance __dict__, and a typo in a field name raises an AttributeError.
+    __slots__ = ('start_time', 'total_time', 'img', 'frame_decoder', 'pos', 'yaw', 'pitch', 'roll', 'vel', 'steer',
+                 'throttle', 'brake', 'nav_angles', 'nav_dists', 'nav_hist', 'rock_hist', 'ground_truth', 'mode',
+                 'throttle_set', 'brake_set', 'history', 'loop_counter', 'stuck_counter', 'stuck_mode',
+                 'stuck_speed_counter', 'rock_detected', 'rock_dist', 'rock_angles', 'starting_counter',
+                 'stop_previous_mode', 'stop_forward', 'go_forward', 'max_vel', 'warp_nearest', 'map_range', 'vision_image',
+                 'worldmap', 'occupancy', 'planner', 'vision_inset', 'map_inset', 'map_stats', 'samples_pos', 'sample_locator',
+                 'near_sample', 'send_pickup', 'picking_up', 'picked_sample_counter', 'samples_to_find',
+                 'samples_located', 'samples_collected', 'iteration_counter', 'events')
+    
     def __init__(self):
         self.start_time = None # To record the start time of navigation
         self.total_time = None # To record total duration of naviagation
         self.img = None # Current camera image
+        self.frame_decoder = FrameDecoder(reduction=1) # Decodes the camera images (set reduction=2, 4 or 8 to decode them at a lower resolution)
         self.pos = None # Current position (x, y)
         self.yaw = None # Current yaw angle
         self.pitch = None # Current pitch angle
@@ -52,18 +70,21 @@ class RoverState():
         self.brake = 0 # Current brake value
         self.nav_angles = None # Angles of navigable terrain pixels
         self.nav_dists = None # Distances of navigable terrain pixels
+        self.nav_hist = None # Angular histogram of navigable terrain pixels
+        self.rock_hist = None # Angular histogram of rock sample pixels
         self.ground_truth = ground_truth_3d # Ground truth worldmap
         self.mode = 'forward' # Current mode (can be forward or stop)
         self.throttle_set = 1 # Throttle setting when accelerating
         self.brake_set = 0.7 # Brake setting when braking
         
-        self.steering_counter = 0 # Keep track of how much we have been moving left to break loops.
+        self.history = PoseHistory() # Recent poses of the rover, to detect loops and stuck situations from its motion.
         self.loop_counter = 0     # Counter to keep moving forward for some time to break loops.
-        self.stuck_counter = 0    # Keep track of how much we have been stuck by some obstacle.
+        self.stuck_counter = 0    # Keep track of how much we have been stuck by some obstacle (frames in forward mode, then in each stuck action).
         self.stuck_mode = ''      # Car mode while in stuck mode.
         self.stuck_speed_counter = 0  # Count how many frames we have gained a speed higher than a threshold.
         self.rock_detected = False # Used to prevent the loop prevention logic from executing while a rock is detected.
         self.rock_dist = None
+        self.rock_angles = None
         self.starting_counter = 0 # A counter to discard any mappings for some time after the start of the simulation to prevent any wrong mappings.
         self.stop_previous_mode = 'forward' # For use when in stop mode.
         
@@ -74,15 +95,25 @@ class RoverState():
         self.stop_forward = 50 # Threshold to initiate stopping. Tweak this to change how much far should the car go near a dead end before stopping.
         self.go_forward = 600  # Threshold to go forward again
         self.max_vel = 4 # Maximum velocity (meters/second)
+        self.warp_nearest = False # Use nearest-neighbour instead of bilinear interpolation for the perspective transform (faster).
+        self.map_range = None # Only map the pixels of the warped image within this distance from the rover (meters, None => no limit)
         # Image output from perception step
         # Update this image to display your intermediate analysis steps
         # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=float) 
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8) # Only 0/255 values
         # Worldmap
         # Update this image with the positions of navigable terrain
         # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=float) 
+        self.worldmap = create_worldmap(200)
+        self.planner = None # Exploration planner steering towards the unexplored areas of the worldmap (see FrontierPlanner)
+        self.occupancy = None # Occupancy grid the navigable terrain and obstacles of the worldmap are derived from (None => hits are accumulated in the worldmap)
+        # Encoders of the images displayed on the left (vision_image) and right (worldmap) insets.
+        # The display doesn't need to be refreshed on every frame, the commands are still sent on every frame.
+        self.vision_inset = InsetEncoder(quality=75, max_rate=20)
+        self.map_inset = InsetEncoder(quality=75, max_rate=20)
+        self.map_stats = MapStatistics(self.worldmap, self.ground_truth) # Mapped %, Fidelity and channel means, kept up to date by perception_step
         self.samples_pos = None # To store the actual sample positions
+        self.sample_locator = None # Spatial index of the sample positions, to know which ones have been located on the worldmap
         self.near_sample = False # If within reach to a rock sample. will be set to telemetry value data["near_sample"]
         self.send_pickup = False # Set to True to trigger rock pickup
         self.picking_up = False # Will be set to telemetry value data["picking_up"]
@@ -92,89 +123,130 @@ class RoverState():
         self.samples_located = 0 # To store number of samples located on map
         self.samples_collected = 0 # To count the number of samples collected
         self.iteration_counter = 0 # Keep track of the iteration number
-# Initialize our rover 
-Rover = RoverState()
+        self.events = EventLog() # Events of the decision and perception steps (state transitions, status...)
+# Rover sessions of the connected simulators, by socketio sid (when the sessions run in this process)
+sessions = {}
+# Options of the new sessions (see RoverSession), set from the command line
+session_options = {'state_class': RoverState}
+# Worker processes running the sessions (None => the sessions run in this process)
+shards = None
+# Process only the most recent frame of each simulator, dropping stale frames (see FramePipeline)
+use_pipeline = False
+# Latest-frame-wins processing pipelines, by sid (pipeline mode only)
+pipelines = {}
+# Timings of the telemetry handler (served as JSON on http://localhost:4567/metrics)
+metrics = Metrics()
 
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
+        metrics.tick('received')
+        # In pipeline mode, only store the frame: the newest one is processed by the pipeline worker.
+        if sid in pipelines:
+            pipelines[sid].submit(sid, data)
         else:
+            process_telemetry(sid, data)
+
+    else:
+        sio.emit('manual', data={}, room=sid)
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+# Define a function to process a telemetry frame: perception, decision and sending the commands
+def process_telemetry(sid, data):
+    deliver_reply(sid, drive_step(sid, data))
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+# Define a function to process a telemetry frame: perception and decision, returns the reply to send (or None)
+def drive_step(sid, data):
+    start = metrics.begin_frame()
+    try:
+        if shards is not None:
+            return metrics.time('shard_step', shards.step, sid, data, metrics)
+        if sid in sessions:
+            return sessions[sid].step(data, metrics)
+        # The simulator has disconnected
+        return None
+    finally:
+        metrics.end_frame(start)
+
+def deliver_reply(sid, reply):
+    # The action step!  Send commands to the rover!
+    if reply is not None:
+        metrics.time('send_control', send_reply, sid, *reply)
 
-    else:
-        sio.emit('manual', data={}, skip_sid=True)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    if shards is not None:
+        shards.open(sid)
+    else:
+        sessions[sid] = RoverSession(sid, **session_options)
+    if use_pipeline:
+        pipelines[sid] = FramePipeline(drive_step, deliver_reply).start()
+    send_control((0, 0, 0), '', '', sid=sid)
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
-
-def send_control(commands, image_string1, image_string2):
-    # Define commands to be sent to the rover
-    data={
-        'throttle': commands[0].__str__(),
-        'brake': commands[1].__str__(),
-        'steering_angle': commands[2].__str__(),
-        'inset_image1': image_string1,
-        'inset_image2': image_string2,
-        }
+        room=sid)
+
+@sio.on('disconnect')
+def disconnect(sid):
+    print("disconnect ", sid)
+    pipeline = pipelines.pop(sid, None)
+    if pipeline is not None:
+        pipeline.stop()
+    if shards is not None:
+        shards.close(sid)
+    elif sid in sessions:
+        sessions.pop(sid).close()
+
+# Serve the timings of the telemetry handler (latency percentiles per stage, frame rates) as JSON
+@app.route('/metrics')
+def metrics_report():
+    report = metrics.snapshot()
+    report['sessions'] = len(shards.assignments) if shards is not None else len(sessions)
+    if pipelines:
+        report['pipelines'] = {sid: pipeline.counters() for sid, pipeline in pipelines.items()}
+    # State of the scheduler and recorder of each session (asked to the workers when the sessions run there)
+    if shards is not None:
+        statuses = shards.status()
+        report['shard_restarts'] = shards.restart_count
+    else:
+        statuses = {sid: session.status() for sid, session in sessions.items()}
+    for name in ('scheduler', 'recorder'):
+        states = {sid: status[name] for sid, status in statuses.items() if name in status}
+        if states:
+            report[name + 's'] = states
+    return jsonify(report)
+
+# Profile the next frames with cProfile, example: http://localhost:4567/metrics/profile?frames=200
+# The profile is saved in the output folder (open it with pstats or snakeviz).
+@app.route('/metrics/profile')
+def metrics_profile():
+    frames = request.args.get('frames', 100, type=int)
+    path = os.path.join('..', 'output', 'profile_{}.prof'.format(datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S')))
+    try:
+        metrics.start_profile(frames, path)
+    except RuntimeError as error:
+        return jsonify({'error': str(error)}), 409
+    return jsonify({'frames': frames, 'path': path})
+
+# Send a reply to a simulator (to all of them if sid is None)
+def send_reply(sid, event, data):
+    if event == 'pickup':
+        print("\nPicking up\r")
     # Send commands via socketIO server
     sio.emit(
-        "data",
+        event,
         data,
-        skip_sid=True)
-    eventlet.sleep(0)
-# Define a function to send the "pickup" command 
-def send_pickup():
-    print("\nPicking up\r")
-    pickup = {}
-    sio.emit(
-        "pickup",
-        pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
+
+def send_control(commands, image_string1, image_string2, frame_id=None, sid=None):
+    send_reply(sid, 'data', control_message(commands, image_string1, image_string2, frame_id))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
     parser.add_argument(
@@ -182,9 +254,110 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to image folder. This is where the images from the run will be saved (in a sub folder per simulator connection).'
+    )
+    parser.add_argument(
+        '--record-format',
+        choices=['jpg', 'npy'],
+        default='jpg',
+        help='Save the recorded frames as JPEG images (jpg) or as chunks of frames in .npy files (npy).'
+    )
+    parser.add_argument(
+        '--record-queue',
+        type=int,
+        default=256,
+        help='Maximum number of frames waiting to be written by the recorder.'
+    )
+    parser.add_argument(
+        '--record-when-full',
+        choices=['drop', 'block'],
+        default='drop',
+        help='What to do with a new frame when the recorder queue is full: drop it or wait for some room.'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Process only the most recent frame in a worker loop, dropping stale frames when processing falls behind.'
+    )
+    parser.add_argument(
+        '--world-size',
+        type=int,
+        default=200,
+        help='Size (in meters/cells) of the square world to map.'
+    )
+    parser.add_argument(
+        '--tile-size',
+        type=int,
+        default=0,
+        help='Store the worldmap in tiles of this size allocated as the rover explores (for large worlds, default: one dense map).'
+    )
+    parser.add_argument(
+        '--occupancy',
+        action='store_true',
+        help='Map the navigable terrain and obstacles with a log-odds occupancy grid instead of accumulating hits.'
+    )
+    parser.add_argument(
+        '--occupancy-half-life',
+        type=float,
+        default=None,
+        help='Number of frames for the evidence of a cell not observed again to fade by half (default: no decay).'
+    )
+    parser.add_argument(
+        '--map-range',
+        type=float,
+        default=0,
+        help='Only map what the camera sees within this distance (in meters) from the rover, the far pixels are the least precise (0 => no limit).'
+    )
+    parser.add_argument(
+        '--explore',
+        action='store_true',
+        help='Steer towards the frontier of the explored area of the worldmap (see FrontierPlanner).'
+    )
+    parser.add_argument(
+        '--frame-budget-ms',
+        type=float,
+        default=0,
+        help='Time budget of a frame: degrade the processing when the frames cost more (0 => every stage runs in full).'
+    )
+    parser.add_argument(
+        '--degrade',
+        type=str,
+        default=','.join(DEGRADATIONS),
+        help='Comma separated degradations applied in order when the frame budget is at risk: '
+             'insets (skip the inset render), worldmap (skip the worldmap update), downscale (half resolution perception).'
+    )
+    parser.add_argument(
+        '--shards',
+        type=int,
+        default=0,
+        help='Run the rover sessions in this many worker processes (0 => in the server process).'
+    )
+    parser.add_argument(
+        '--verbosity',
+        choices=['debug', 'info', 'quiet'],
+        default='info',
+        help='Events printed on the console: debug (every frame status), info (state transitions) or quiet.'
+    )
+    parser.add_argument(
+        '--events-dump',
+        type=str,
+        default='',
+        help='Save the recorded events of each simulator connection in <name>_<sid>.npy when it closes (print it with events.py).'
     )
     args = parser.parse_args()
+    session_options['console_level'] = {'debug': DEBUG, 'info': INFO, 'quiet': QUIET}[args.verbosity]
+    session_options['events_dump'] = args.events_dump
+    if args.world_size != 200 or args.tile_size:
+        session_options['worldmap'] = {'world_size': args.world_size, 'tile_size': args.tile_size}
+    if args.occupancy:
+        session_options['occupancy'] = {'half_life': args.occupancy_half_life}
+    if args.map_range > 0:
+        session_options['map_range'] = args.map_range
+    if args.explore:
+        session_options['explore'] = True
+    if args.frame_budget_ms > 0:
+        session_options['scheduler'] = {'budget_ms': args.frame_budget_ms,
+                                        'order': [name for name in args.degrade.split(',') if name]}
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -195,11 +368,29 @@ if __name__ == '__main__':
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
         print("Recording this run ...")
+        session_options['record_folder'] = args.image_folder
+        session_options['record_options'] = {'container': args.record_format, 'queue_size': args.record_queue,
+                                             'when_full': args.record_when_full}
     else:
         print("NOT recording this run ...")
     
+    if args.pipeline:
+        print("Processing frames in pipeline mode (latest frame wins)")
+        use_pipeline = True
+    
+    if args.shards > 0:
+        print("Running the rover sessions in {} worker processes".format(args.shards))
+        shards = ShardPool(args.shards, session_options)
+    
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        # Close the sessions still open (write the frames waiting in the recorder queues, events dumps...)
+        for session in sessions.values():
+            session.close()
+        if shards is not None:
+            shards.shutdown()
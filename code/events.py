@@ -0,0 +1,154 @@
+import sys
+import time
+
+import numpy as np
+
+# Verbosity levels
+DEBUG = 10  # Per-frame status ("Normal forward movement", number of navigable angles...)
+INFO = 20   # State transitions (dead end, stuck, loop...) and mapping events
+QUIET = 100 # Nothing
+
+# Event codes
+NEAR_SAMPLE = 1
+PICKUP = 2
+STUCK = 3
+STUCK_ACTION = 4
+STUCK_NEXT_ACTION = 5
+UNSTUCK = 6
+RETURNING = 7
+RETURNED = 8
+LOOP = 9
+LOOP_FORWARD = 10
+LOOP_END = 11
+NAV_STATUS = 12
+ROCK_STEER = 13
+FORWARD = 14
+DEAD_END = 15
+STOPPING = 16
+APPROACHING_SAMPLE = 17
+STOPPED_BLOCKED = 18
+GO_FORWARD = 19
+NO_NAV_DATA = 20
+STARTING_DELAY = 21
+MAPPING_STARTED = 22
+MAP_CLEANUP = 23
+
+# Level and console message of each event code.
+# The message can use the fields of the event: {frame}, {mode}, {stuck_mode}, {value1} and {value2}.
+EVENT_TYPES = {
+    NEAR_SAMPLE: (DEBUG, "Near a sample! {frame}"),
+    PICKUP: (INFO, "Stopped near a sample, sending the pickup command."),
+    STUCK: (INFO, "Stuck by some obstacle (moved {value1:.2f} m in {value2:.0f} frames)! Entering 'stuck' mode."),
+    STUCK_ACTION: (DEBUG, "Stuck by some obstacle! Performing '{stuck_mode}' action. {frame}"),
+    STUCK_NEXT_ACTION: (INFO, "Still stuck, switching to '{stuck_mode}' action."),
+    UNSTUCK: (INFO, "Broke out of the stuck position."),
+    RETURNING: (DEBUG, "Returning back some distance. {frame}"),
+    RETURNED: (INFO, "Moved away from the picked sample."),
+    LOOP: (INFO, "Stuck in a loop (turned {value1:.0f} degrees, {value2:.1f} m away)! Changing to moving forward."),
+    LOOP_FORWARD: (DEBUG, "Stuck in a loop! Moving forward. {frame}"),
+    LOOP_END: (INFO, "Out of the loop."),
+    NAV_STATUS: (DEBUG, "NAs={value1:.0f}, SAs={value2:.0f}"),
+    ROCK_STEER: (DEBUG, "Sample detected, SAV={value1:0.2f}. {frame}"),
+    FORWARD: (DEBUG, "Normal forward movement. {frame}"),
+    DEAD_END: (INFO, "Dead end!"),
+    STOPPING: (DEBUG, "Stopping... {frame}"),
+    APPROACHING_SAMPLE: (DEBUG, "Approaching sample, adjusting speed... {frame}"),
+    STOPPED_BLOCKED: (DEBUG, "Stopped and can't go forward. {frame}"),
+    GO_FORWARD: (INFO, "Stopped but can go forward."),
+    NO_NAV_DATA: (DEBUG, "No enough angles data received: {value1:.0f} angles. Steering... ({frame})"),
+    STARTING_DELAY: (DEBUG, "Starting the simulation. Delayed mapping: {value1:.0f}/120"),
+    MAPPING_STARTED: (INFO, "End of the starting delay, mapping started."),
+    MAP_CLEANUP: (INFO, "Cleared low certainty navigable terrain. Mean blue pixels value: {value1:.0f}"),
+}
+
+# Modes of the Rover, stored as their index in the events
+MODES = ('forward', 'stop', 'stuck', 'loop', 'picked-sample')
+STUCK_MODES = ('', 'forward', 'steer', 'forward2', 'backward')
+UNKNOWN = 255
+
+EVENT_DTYPE = np.dtype([('time', 'f8'),     # time.time() of the event
+                        ('frame', 'i4'),    # Rover.iteration_counter
+                        ('code', 'u1'),     # Event code
+                        ('level', 'u1'),
+                        ('mode', 'u1'),     # Index of Rover.mode in MODES
+                        ('stuck_mode', 'u1'), # Index of Rover.stuck_mode in STUCK_MODES
+                        ('value1', 'f4'),   # Values of the event (see the messages)
+                        ('value2', 'f4')])
+
+# Define a function to format an event (a record of an EVENT_DTYPE array) as its console message
+def format_event(event):
+    _, message = EVENT_TYPES[int(event['code'])]
+    mode, stuck_mode = int(event['mode']), int(event['stuck_mode'])
+    return message.format(frame=int(event['frame']),
+                          mode=MODES[mode] if mode < len(MODES) else '?',
+                          stuck_mode=STUCK_MODES[stuck_mode] if stuck_mode < len(STUCK_MODES) else '?',
+                          value1=float(event['value1']), value2=float(event['value2']))
+
+# Define a class recording the events of the decision and perception steps in a preallocated ring buffer
+# (only the last `size` events are kept), instead of printing them on every frame.
+# => level: events below this level are not recorded.
+# => console_level: events at or above this level are also printed, at most console_rate lines per second.
+# => dump(): save the recorded events (binary .npy file) for post-mortem analysis, read them back with load().
+class EventLog():
+    def __init__(self, size=4096, level=DEBUG, console_level=INFO, console_rate=5):
+        self.events = np.zeros(size, dtype=EVENT_DTYPE)
+        self.count = 0 # Total number of events recorded (only the last `size` ones are kept)
+        self.level = level
+        self.console_level = console_level
+        self.console_rate = console_rate
+        self.console_tokens = console_rate # Lines that can be printed right now (refilled at console_rate per second)
+        self.console_time = time.monotonic()
+        self.suppressed_count = 0 # Lines not printed since the last printed line because of the rate limit
+
+    def log(self, code, Rover, value1=0, value2=0):
+        level = EVENT_TYPES[code][0]
+        if level < self.level:
+            return
+        event = self.events[self.count % len(self.events)]
+        event['time'] = time.time()
+        event['frame'] = Rover.iteration_counter
+        event['code'] = code
+        event['level'] = level
+        event['mode'] = MODES.index(Rover.mode) if Rover.mode in MODES else UNKNOWN
+        event['stuck_mode'] = STUCK_MODES.index(Rover.stuck_mode) if Rover.stuck_mode in STUCK_MODES else UNKNOWN
+        event['value1'] = value1
+        event['value2'] = value2
+        self.count += 1
+
+        if level >= self.console_level:
+            self._print(event)
+
+    # Recorded events, oldest first
+    def recorded(self):
+        size = len(self.events)
+        if self.count <= size:
+            return self.events[:self.count].copy()
+        start = self.count % size
+        return np.concatenate((self.events[start:], self.events[:start]))
+
+    def dump(self, path):
+        np.save(path, self.recorded())
+
+    @staticmethod
+    def load(path):
+        return np.load(path)
+
+    def _print(self, event):
+        now = time.monotonic()
+        self.console_tokens = min(self.console_rate, self.console_tokens + (now - self.console_time) * self.console_rate)
+        self.console_time = now
+        if self.console_tokens < 1:
+            self.suppressed_count += 1
+            return
+        self.console_tokens -= 1
+        message = format_event(event)
+        if self.suppressed_count:
+            message += " ({} more events not printed)".format(self.suppressed_count)
+            self.suppressed_count = 0
+        print(message)
+
+if __name__ == '__main__':
+    # Print the events of a dump, example: $ python events.py ../output/events.npy
+    for event in EventLog.load(sys.argv[1]):
+        print("{:.3f} [{}] {}".format(event['time'], MODES[event['mode']] if event['mode'] < len(MODES) else '?',
+                                      format_event(event)))
@@ -0,0 +1,103 @@
+import math
+
+import numpy as np
+
+# Define a class keeping the last `size` poses (position and yaw) of the rover in preallocated ring buffers,
+# to detect loops and stuck situations from the motion of the rover instead of counting frames of a command.
+# => The cumulative path length and the unwrapped heading are stored with each pose, so the net displacement,
+#    path length and heading drift over the last frames are differences of two ring buffer entries.
+# => The positions are hashed into coarse cells (cell_size meters) and a fixed-size table (hash_size buckets)
+#    counts the visits of each cell in the history (a visit starts when the rover enters a cell it hasn't been
+#    in for revisit_gap frames), so how often the rover comes back to its current cell is a lookup.
+# Every query is O(1) per frame. reset() forgets the poses recorded so far (when the rover changes its behavior).
+class PoseHistory():
+    def __init__(self, size=2000, cell_size=3.0, hash_size=4096, revisit_gap=100):
+        self.size = size
+        self.cell_size = cell_size
+        self.revisit_gap = revisit_gap
+        self.x = np.zeros(size)
+        self.y = np.zeros(size)
+        self.heading = np.zeros(size)    # Unwrapped yaw (degrees), the turns add up instead of wrapping at 360
+        self.travelled = np.zeros(size)  # Path length since the first pose (meters)
+        self.buckets = np.zeros(size, dtype=np.int32) # Hash bucket of the cell of each pose
+        self.visit_starts = np.zeros(size, dtype=bool) # Whether each pose started a visit of its cell
+        self.visit_counts = np.zeros(hash_size, dtype=np.int32) # Number of visits in the history of the cells of each bucket
+        self.last_seen = np.full(hash_size, -revisit_gap - 1, dtype=np.int64) # Number of the last pose in each bucket
+        self.count = 0 # Total number of poses added
+        self.start = 0 # Number of the first pose since the last reset
+        self.last_yaw = 0.0
+
+    def add(self, xpos, ypos, yaw):
+        idx = self.count % self.size
+        # The oldest pose leaves the history
+        if self.count - self.size >= self.start and self.visit_starts[idx]:
+            self.visit_counts[self.buckets[idx]] -= 1
+
+        if self.count > self.start:
+            previous = (self.count - 1) % self.size
+            self.travelled[idx] = self.travelled[previous] + math.hypot(xpos - self.x[previous], ypos - self.y[previous])
+            self.heading[idx] = self.heading[previous] + (yaw - self.last_yaw + 180) % 360 - 180
+        else:
+            self.travelled[idx] = 0.0
+            self.heading[idx] = yaw
+        self.x[idx] = xpos
+        self.y[idx] = ypos
+        self.last_yaw = yaw
+
+        bucket = self.bucket(xpos, ypos)
+        visit_start = self.count - self.last_seen[bucket] > self.revisit_gap
+        self.buckets[idx] = bucket
+        self.visit_starts[idx] = visit_start
+        if visit_start:
+            self.visit_counts[bucket] += 1
+        self.last_seen[bucket] = self.count
+        self.count += 1
+
+    # Forget the poses recorded so far
+    def reset(self):
+        self.start = self.count
+        self.visit_counts[:] = 0
+        self.last_seen[:] = -self.revisit_gap - 1
+
+    def bucket(self, xpos, ypos):
+        cell_x, cell_y = int(xpos // self.cell_size), int(ypos // self.cell_size)
+        return ((cell_x * 73856093) ^ (cell_y * 19349663)) % len(self.visit_counts)
+
+    # Number of poses recorded since the last reset and still in the history
+    def __len__(self):
+        return min(self.count - self.start, self.size)
+
+    # Ring buffer index of the pose `frames` frames before the last one
+    def index(self, frames=0):
+        return (self.count - 1 - frames) % self.size
+
+    # Straight line distance between the last pose and the pose `frames` frames before
+    def displacement(self, frames):
+        last, first = self.index(), self.index(frames)
+        return math.hypot(self.x[last] - self.x[first], self.y[last] - self.y[first])
+
+    # Distance driven over the last `frames` frames
+    def path_length(self, frames):
+        return self.travelled[self.index()] - self.travelled[self.index(frames)]
+
+    # Signed heading change (degrees, positive to the left) over the last `frames` frames
+    def heading_drift(self, frames):
+        return self.heading[self.index()] - self.heading[self.index(frames)]
+
+    # Number of times the rover came back to the cell of the last pose within the history (hash collisions included)
+    def revisits(self):
+        return max(int(self.visit_counts[self.buckets[self.index()]]) - 1, 0)
+
+    # Whether the rover has moved less than `distance` meters away from where it was `frames` frames ago
+    def stuck(self, frames=60, distance=0.5):
+        return len(self) > frames and self.displacement(frames) < distance
+
+    # Whether the rover is driving in circles: over the last `frames` frames, it has driven at least min_path meters
+    # and turned (almost) a full circle while staying within `radius` meters, or within the history, it has driven
+    # at least revisit_path meters and came back to its current cell at least min_revisits times.
+    def looping(self, frames=600, min_path=5.0, min_drift=300, radius=8.0, revisit_path=20.0, min_revisits=2):
+        if len(self) <= frames or self.path_length(frames) < min_path:
+            return False
+        if abs(self.heading_drift(frames)) >= min_drift and self.displacement(frames) < radius:
+            return True
+        return self.path_length(len(self) - 1) >= revisit_path and self.revisits() >= min_revisits
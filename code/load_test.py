@@ -0,0 +1,160 @@
+import time
+import random
+import argparse
+import threading
+
+import numpy as np
+import socketio
+
+from replay import read_log, telemetry_message
+
+# Headless stand-in for the simulator, to load test drive_rover.py without Unity.
+# It connects to the server, sends the frames of a recording as 'telemetry' messages at a given rate
+# and measures the round-trip latency (telemetry -> 'data'/'pickup' reply) and the sustained throughput.
+# Each message carries a frame_id, which the server echoes in its reply.
+# Needs the socketio client dependencies: $ pip install requests "websocket-client<1.0"
+# Examples (with $ python drive_rover.py running):
+# $ python load_test.py --fps 30 --duration 20
+# $ python load_test.py --fps 60 --burst 5 --jitter-ms 10
+# $ python load_test.py --ramp 10,20,40,80,160 --duration 10   (find the rate the server can hold)
+
+# Define a class sending telemetry frames to the server and collecting the replies
+class LoadTester():
+    def __init__(self, url, messages):
+        self.url = url
+        self.messages = messages # Telemetry messages to send (in a loop)
+        self.next_message = 0
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.sent_times = {}     # Send time of the frames waiting for a reply, by frame_id
+        self.latencies = []      # Round-trip latencies (seconds) of the replied frames
+        self.reply_count = 0     # Replies received, including the ones without a known frame_id
+        self.pickup_count = 0
+        # Times of the first and last replies of the run (the connection reply can arrive before the first run)
+        self.first_reply_time = None
+        self.last_reply_time = None
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('data', self._on_reply)
+        self.sio.on('pickup', self._on_pickup)
+
+    def connect(self):
+        self.sio.connect(self.url, transports=['websocket'])
+        return self
+
+    def close(self):
+        self.sio.disconnect()
+
+    # Send frames at `fps` frames per second for `duration` seconds.
+    # burst: frames sent back to back at a time (the average rate stays `fps`).
+    # jitter: maximum random offset (seconds) added to each send time.
+    # Returns the statistics of the run (see stats()).
+    def run(self, fps, duration, burst=1, jitter=0, grace=1):
+        self.reset()
+        start = time.monotonic()
+        sent = 0
+        while time.monotonic() - start < duration:
+            for _ in range(burst):
+                self.send()
+                sent += 1
+            # Wait for the next burst, on a fixed schedule so the rate doesn't drift.
+            next_time = start + sent / fps + random.uniform(-jitter, jitter)
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        send_duration = time.monotonic() - start
+        # Wait for the replies of the last frames.
+        time.sleep(grace)
+        return self.stats(sent, send_duration)
+
+    def send(self):
+        data = dict(self.messages[self.next_message])
+        self.next_message = (self.next_message + 1) % len(self.messages)
+        with self.lock:
+            frame_id = self.next_id
+            self.next_id += 1
+            self.sent_times[frame_id] = time.monotonic()
+        data['frame_id'] = frame_id
+        self.sio.emit('telemetry', data)
+
+    def reset(self):
+        with self.lock:
+            self.sent_times.clear()
+            self.latencies = []
+            self.reply_count = 0
+            self.pickup_count = 0
+            self.first_reply_time = self.last_reply_time = None
+
+    def stats(self, sent, send_duration):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'sent': sent,
+                     'send_fps': sent / send_duration,
+                     'replies': self.reply_count,
+                     'pickups': self.pickup_count,
+                     # Frames without a reply (dropped by the pipeline mode, or still waiting)
+                     'unanswered': len(self.sent_times)}
+            if self.reply_count > 1 and self.last_reply_time > self.first_reply_time:
+                stats['reply_fps'] = (self.reply_count - 1) / (self.last_reply_time - self.first_reply_time)
+            if len(latencies):
+                p50, p95, p99 = np.percentile(latencies, (50, 95, 99))
+                stats.update({'latency_p50_ms': float(p50), 'latency_p95_ms': float(p95),
+                              'latency_p99_ms': float(p99), 'latency_max_ms': float(latencies.max())})
+        return stats
+
+    def _on_reply(self, data):
+        now = time.monotonic()
+        with self.lock:
+            self.reply_count += 1
+            if self.first_reply_time is None:
+                self.first_reply_time = now
+            self.last_reply_time = now
+            sent_time = self.sent_times.pop(data.get('frame_id'), None)
+            if sent_time is not None:
+                self.latencies.append(now - sent_time)
+
+    def _on_pickup(self, data):
+        with self.lock:
+            self.pickup_count += 1
+        self._on_reply(data)
+
+# Define a function to print the statistics of a run
+def print_stats(fps, stats):
+    line = "{:>7.1f} fps | sent {:>6} ({:>6.1f} fps) | replies {:>6} ({:>6.1f} fps) | unanswered {:>5}".format(
+        fps, stats['sent'], stats['send_fps'], stats['replies'], stats.get('reply_fps', 0), stats['unanswered'])
+    if 'latency_p50_ms' in stats:
+        line += " | latency p50 {:.1f} ms, p95 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms".format(
+            stats['latency_p50_ms'], stats['latency_p95_ms'], stats['latency_p99_ms'], stats['latency_max_ms'])
+    print(line)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the drive_rover server with a recorded run')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='Address of the server.')
+    parser.add_argument('--log', type=str, default='../test_dataset/robot_log.csv', help='Recording to replay.')
+    parser.add_argument('--images', type=str, default=None,
+                        help='Folder of images to use instead of the Path column of the log (see replay.py).')
+    parser.add_argument('--fps', type=float, default=30, help='Frames sent per second.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of sending (per rate with --ramp).')
+    parser.add_argument('--burst', type=int, default=1, help='Frames sent back to back at a time (same average rate).')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Maximum random offset added to each send time (ms).')
+    parser.add_argument('--ramp', type=str, default='',
+                        help='Comma separated rates to run one after the other, instead of --fps.')
+    parser.add_argument('--max-latency-ms', type=float, default=100,
+                        help='With --ramp, p95 latency above which the server is considered unable to hold the rate.')
+    args = parser.parse_args()
+
+    messages = [telemetry_message(frame) for frame in read_log(args.log, args.images)]
+    tester = LoadTester(args.url, messages).connect()
+    try:
+        rates = [float(rate) for rate in args.ramp.split(',')] if args.ramp else [args.fps]
+        held = None
+        for fps in rates:
+            stats = tester.run(fps, args.duration, burst=args.burst, jitter=args.jitter_ms / 1000)
+            print_stats(fps, stats)
+            if stats.get('latency_p95_ms', np.inf) <= args.max_latency_ms and stats['unanswered'] == 0:
+                held = fps
+        if args.ramp:
+            print("Highest rate held (p95 latency <= {} ms, no unanswered frames): {}".format(
+                args.max_latency_ms, "{} fps".format(held) if held is not None else 'none'))
+    finally:
+        tester.close()
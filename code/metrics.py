@@ -0,0 +1,129 @@
+import time
+import cProfile
+
+import numpy as np
+
+# Define a class keeping the last `size` samples of a latency (in seconds) to compute its percentiles.
+# Adding a sample is only a store in a preallocated array, the percentiles are computed when requested.
+class RollingHistogram():
+    def __init__(self, size=1024):
+        self.samples = np.zeros(size)
+        self.count = 0 # Total number of samples added (only the last `size` ones are kept)
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def summary(self):
+        samples = self.samples[:min(self.count, len(self.samples))] * 1000
+        if len(samples) == 0:
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(samples, (50, 95, 99))
+        return {'count': self.count, 'mean_ms': float(np.mean(samples)), 'p50_ms': float(p50),
+                'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(np.max(samples))}
+
+# Define a class measuring the rate of an event (frames per second) over its last `size` occurrences
+class RateCounter():
+    def __init__(self, size=64):
+        self.times = np.zeros(size)
+        self.count = 0
+
+    def tick(self):
+        self.times[self.count % len(self.times)] = time.monotonic()
+        self.count += 1
+
+    def rate(self):
+        size = len(self.times)
+        if self.count < 2:
+            return 0.0
+        newest = self.times[(self.count - 1) % size]
+        oldest = self.times[self.count % size] if self.count > size else self.times[0]
+        # Treat the rate as 0 once nothing has happened for a while.
+        if time.monotonic() - newest > 1 or newest <= oldest:
+            return 0.0
+        return (min(self.count, size) - 1) / (newest - oldest)
+
+# Define a class recording the stage timings of frames processed in another process (see ShardPool),
+# to be added to the Metrics of the server. It has the same time/add methods as Metrics.
+class StageTimings():
+    def __init__(self):
+        self.samples = [] # (stage, duration) pairs recorded since the last drain
+
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def add(self, stage, duration):
+        self.samples.append((stage, duration))
+
+    # Return the samples recorded so far and forget them
+    def drain(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+# Define a class collecting the timings of the telemetry handler:
+# => a latency histogram per stage (update_rover, perception_step...) and for the whole frame
+# => frame rate counters (frames received from the simulator, frames processed)
+# => on demand, a cProfile profile of the next frames
+class Metrics():
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = {}
+        self.rates = {}
+
+        self.profiler = None          # Profiler of the frames being profiled
+        self.profile_remaining = 0    # Number of frames left to profile
+        self.profile_path = None      # Where the running profile will be saved
+        self.last_profile_path = None # Last saved profile
+
+    # Call func(*args), add its duration to the histogram of `stage` and return its result
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def add(self, stage, duration):
+        if stage not in self.histograms:
+            self.histograms[stage] = RollingHistogram(self.window)
+        self.histograms[stage].add(duration)
+
+    def tick(self, counter):
+        if counter not in self.rates:
+            self.rates[counter] = RateCounter()
+        self.rates[counter].tick()
+
+    # Profile the next `frames` frames and save the profile (pstats format) in `path`.
+    def start_profile(self, frames, path):
+        if self.profile_remaining > 0:
+            raise RuntimeError("A profile is already running")
+        self.profile_remaining = frames
+        self.profile_path = path
+
+    # Call at the start of a frame, returns the start time to pass to end_frame
+    def begin_frame(self):
+        if self.profile_remaining > 0:
+            if self.profiler is None:
+                self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return time.perf_counter()
+
+    def end_frame(self, start):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profile_remaining -= 1
+            if self.profile_remaining <= 0:
+                self.profiler.dump_stats(self.profile_path)
+                self.last_profile_path = self.profile_path
+                self.profiler = None
+        self.add('frame', time.perf_counter() - start)
+        self.tick('processed')
+
+    def snapshot(self):
+        return {'stages': {stage: histogram.summary() for stage, histogram in self.histograms.items()},
+                'fps': {counter: rate.rate() for counter, rate in self.rates.items()},
+                'profile': {'remaining_frames': self.profile_remaining,
+                            'path': self.profile_path if self.profile_remaining > 0 else None,
+                            'last_path': self.last_profile_path}}
@@ -1,6 +1,9 @@
 import numpy as np
 import cv2
 
+import events
+from worldmap import count_hits, add_hits, write_cells, set_masked, map_values, create_worldmap, TiledWorldmap
+
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
 def color_thresh(img, rgb_thresh_min=(160, 160, 160), rgb_thresh_max=(255, 255, 255)): # 215, 205, 180
@@ -23,6 +26,63 @@ def color_thresh(img, rgb_thresh_min=(160, 160, 160), rgb_thresh_max=(255, 255,
     # Return the binary image
     return img_mask
 
+# Define a class that classifies every pixel of an image into terrain classes in a single pass.
+# Each class is an RGB range like the ones passed to color_thresh (min exclusive, max inclusive).
+# Since the ranges are boxes in RGB space, a pixel belongs to a class when each of its channels is
+# inside the range of that channel, so one 256-entry table per channel (a bit per class) is enough.
+class TerrainClassifier():
+    def __init__(self, thresholds):
+        self.thresholds = None
+        self.set_thresholds(thresholds)
+    
+    # thresholds: a list of (rgb_thresh_min, rgb_thresh_max) pairs, one per class (up to 8 classes).
+    def set_thresholds(self, thresholds):
+        thresholds = tuple((tuple(rgb_min), tuple(rgb_max)) for rgb_min, rgb_max in thresholds)
+        # Only rebuild the tables when the thresholds have actually changed.
+        if thresholds == self.thresholds:
+            return
+        self.thresholds = thresholds
+        
+        # Per-channel tables: bit k of channel_lut[value, 0, channel] is set if value is inside the range of class k.
+        values = np.arange(256)
+        channel_lut = np.zeros((256, 1, 3), dtype=np.uint8)
+        for class_idx, (rgb_min, rgb_max) in enumerate(thresholds):
+            for channel in range(3):
+                in_range = (values > rgb_min[channel]) & (values <= rgb_max[channel])
+                channel_lut[:, 0, channel] |= (in_range << class_idx).astype(np.uint8)
+        self.channel_lut = channel_lut
+        
+        # Table to unpack a label (bit field) into one 0/1 mask per class (up to 3 classes, one per channel).
+        labels = np.arange(256)
+        mask_lut = np.zeros((256, 1, 3), dtype=np.uint8)
+        for class_idx in range(min(len(thresholds), 3)):
+            mask_lut[:, 0, class_idx] = (labels >> class_idx) & 1
+        self.mask_lut = mask_lut
+    
+    # Return a label image where bit k is set for the pixels of class k.
+    def labels(self, img):
+        channel_bits = cv2.split(cv2.LUT(img, self.channel_lut))
+        return cv2.bitwise_and(cv2.bitwise_and(channel_bits[0], channel_bits[1]), channel_bits[2])
+    
+    # Return a (height, width, 3) image holding the binary mask of each class in its own channel.
+    # The mask of class k (identical to color_thresh with the same thresholds) is the view masks[:, :, k].
+    # label_mask: optional (height, width) uint8 image and-ed with the labels (a pixel only keeps the classes of its bits).
+    def masks(self, img, label_mask=None):
+        labels = self.labels(img)
+        if label_mask is not None:
+            labels = cv2.bitwise_and(labels, label_mask)
+        return cv2.LUT(cv2.merge((labels, labels, labels)), self.mask_lut)
+
+# Classifiers already built, keyed by their thresholds.
+_classifiers = {}
+
+# Define a function to get the (cached) classifier for a set of thresholds
+def get_classifier(thresholds):
+    key = tuple((tuple(rgb_min), tuple(rgb_max)) for rgb_min, rgb_max in thresholds)
+    if key not in _classifiers:
+        _classifiers[key] = TerrainClassifier(key)
+    return _classifiers[key]
+
 # Define a function to convert from image coords to rover coords
 def rover_coords(binary_img):
     # Identify nonzero pixels.
@@ -44,6 +104,99 @@ def to_polar_coords(x_pixel, y_pixel):
     
     return dist, angles
 
+# Number of bins of the angular histograms, covering the angles in front of the rover (-90 to 90 degrees).
+ANGLE_BINS = 90
+
+# Define a class holding a fixed-size summary of the polar angles of a set of pixels:
+# for each angular bin, the number of pixels and the sum of their angles.
+# The decision step only needs counts and (partial) means of the angles, which can be computed
+# from the bins without going through (or sorting) all the pixels.
+class AngularHistogram():
+    def __init__(self, counts, angle_sums):
+        self.counts = counts         # Number of pixels in each bin (from right, -90 degrees, to left, +90 degrees)
+        self.angle_sums = angle_sums # Sum of the angles of the pixels of each bin
+        self.count = int(counts.sum())
+    
+    # Mean angle of all the pixels (0 if there are none)
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.angle_sums.sum() / self.count)
+    
+    # Mean angle of the left half of the pixels, same as np.mean(np.sort(angles)[int(len(angles)/2):])
+    # up to the pixels of the bin where the half falls, which are taken at the mean angle of that bin.
+    def left_half_mean(self):
+        keep = self.count - int(self.count/2)
+        if keep == 0:
+            return 0.0
+        counts, angle_sums = self.counts[::-1], self.angle_sums[::-1]
+        cumulated = np.cumsum(counts)
+        last = int(np.searchsorted(cumulated, keep))
+        taken = cumulated[last - 1] if last > 0 else 0
+        total = angle_sums[:last].sum() + (keep - taken) * angle_sums[last] / counts[last]
+        return float(total / keep)
+    
+    # Number of pixels with an angle between low and high (radians), counting the bins they fall in
+    def count_between(self, low, high):
+        bins = np.clip(((np.array([low, high]) + np.pi/2) * (ANGLE_BINS / np.pi)).astype(int), 0, ANGLE_BINS - 1)
+        return int(self.counts[bins[0]:bins[1] + 1].sum())
+    
+    # Histogram of an image `factor` times larger in each dimension: each pixel stands for factor^2 pixels.
+    def scaled(self, factor):
+        return AngularHistogram(self.counts * factor**2, self.angle_sums * factor**2)
+
+# Define a class that holds the rover-centric and polar coordinates of every pixel of an image.
+# These only depend on the pixel position, so they are computed once (in float32) per image shape
+# and the coordinates of the selected pixels are then gathered by their flat pixel index.
+class PixelCoordinateTables():
+    def __init__(self, img_shape):
+        self.img_shape = tuple(img_shape[:2])
+        ypos, xpos = np.indices(self.img_shape)
+        
+        # Same conventions as rover_coords: the rover is at the center bottom of the image.
+        x_pixel = -(ypos - self.img_shape[0]).astype(float)
+        y_pixel = -(xpos - self.img_shape[1]/2).astype(float)
+        dist, angles = to_polar_coords(x_pixel, y_pixel)
+        
+        self.x_pixel = x_pixel.ravel().astype(np.float32)
+        self.y_pixel = y_pixel.ravel().astype(np.float32)
+        self.dist = dist.ravel().astype(np.float32)
+        self.angles = angles.ravel().astype(np.float32)
+        # Angular histogram bin of each pixel
+        self.angle_bins = np.clip(((angles.ravel() + np.pi/2) * (ANGLE_BINS / np.pi)).astype(int), 0, ANGLE_BINS - 1)
+    
+    # Return the flat indices of the nonzero pixels (in the same order as binary_img.nonzero()).
+    def pixel_indices(self, binary_img):
+        return np.flatnonzero(binary_img)
+    
+    # Equivalent to rover_coords() for the pixels at the given flat indices.
+    def rover_coords(self, pixel_idx):
+        return self.x_pixel[pixel_idx], self.y_pixel[pixel_idx]
+    
+    # Equivalent to to_polar_coords() for the pixels at the given flat indices.
+    def polar_coords(self, pixel_idx):
+        return self.dist[pixel_idx], self.angles[pixel_idx]
+    
+    # The pixels of the given flat indices at most max_dist pixels away from the rover.
+    def within_range(self, pixel_idx, max_dist):
+        return pixel_idx[self.dist[pixel_idx] <= max_dist]
+    
+    # Angular histogram of the pixels at the given flat indices.
+    def angular_histogram(self, pixel_idx):
+        bins = self.angle_bins[pixel_idx]
+        return AngularHistogram(np.bincount(bins, minlength=ANGLE_BINS),
+                                np.bincount(bins, self.angles[pixel_idx], minlength=ANGLE_BINS))
+
+# Coordinate tables already built, keyed by the image shape.
+_coordinate_tables = {}
+
+# Define a function to get the (cached) coordinate tables for an image shape
+def get_coordinate_tables(img_shape):
+    key = tuple(img_shape[:2])
+    if key not in _coordinate_tables:
+        _coordinate_tables[key] = PixelCoordinateTables(key)
+    return _coordinate_tables[key]
+
 # Define a function to map rover space pixels to world space
 def rotate_pix(xpix, ypix, yaw):
     # Convert yaw to radians.
@@ -78,90 +231,347 @@ def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
     
     return x_pix_world, y_pix_world
 
-def perspect_transform(img, src, dst):
-    # Get a transformation matrix from the corners of the desired image section and a matrix containting the new image corner pixels.
-    trans_matrix = cv2.getPerspectiveTransform(src, dst)
-    
-    # Inputs are: [The original image, transformation matrix, the (height (y), width (x)) of the output image]
-    # Since we want to keep same size of the input image, we need to pass its shape.
-    return cv2.warpPerspective(img, trans_matrix, (img.shape[1], img.shape[0]))
+# The pixel coordinates below are found by opening `example_grid1.jpg` with paint and hovering over the grid corners
+CALIBRATION_SOURCE = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]]) # (B)ottom (L)eft, BR, TR, TL
+# Shape (height, width) of the rover camera images the source points were picked on.
+CAMERA_SHAPE = (160, 320)
 
+# Define a function to get the destination points of the perspective transform for an image shape
+def destination_points(img_shape, dst_size=5, bottom_offset=10):
+    return np.float32([[img_shape[1]/2 - dst_size, img_shape[0] - bottom_offset],    # Y-size center - dst_size, X-size - btm_offset
+                    [img_shape[1]/2 + dst_size, img_shape[0] - bottom_offset],              # Y-size center + dst_size, X-size - btm_offset
+                    [img_shape[1]/2 + dst_size, img_shape[0] - 2*dst_size - bottom_offset], # Y-size center + dst_size, X-size - 2*dst_size - btm_offset
+                    [img_shape[1]/2 - dst_size, img_shape[0] - 2*dst_size - bottom_offset], # Y-size center - dst_size, X-size - 2*dst_size - btm_offset
+                    ])
 
-# Apply the above functions in succession and update the Rover state accordingly
-def perception_step(Rover):
-    # Make sure to not update the map at the start of the simulation to prevent wrong values.
-    # if s:=all([abs(abs(Rover.pos[0]) - 99.7) <= 1, abs(abs(Rover.pos[1]) - 85.6) <= 1]) and (Rover.samples_collected in [0, 6]):
-    #     print(f"Near the starting position of the simulation {s}. No mapping is done.")
-    #     return Rover
-    
-    # Perform perception steps to update Rover()
-    # NOTE: camera image is coming to you in Rover.img
-    image = Rover.img
-    
-    ## 1) Define source and destination points for perspective transform
+# Build the fixed-point maps used by cv2.remap for an inverse transformation matrix.
+# This follows what cv2.warpPerspective does internally (same summation order and rounding),
+# so remapping with these maps gives exactly the same output as warping the image.
+def _remap_tables(inv_matrix, img_shape, tab_size):
+    ypos, xpos = np.mgrid[0:img_shape[0], 0:img_shape[1]].astype(np.float64)
+    w = (inv_matrix[2, 1]*ypos + inv_matrix[2, 2]) + inv_matrix[2, 0]*xpos
+    with np.errstate(divide='ignore'):
+        w = np.where(w != 0, tab_size / w, 0)
+    int_limits = (np.iinfo(np.int32).min, np.iinfo(np.int32).max)
+    x_fixed = np.rint(np.clip(((inv_matrix[0, 1]*ypos + inv_matrix[0, 2]) + inv_matrix[0, 0]*xpos) * w, *int_limits)).astype(np.int64)
+    y_fixed = np.rint(np.clip(((inv_matrix[1, 1]*ypos + inv_matrix[1, 2]) + inv_matrix[1, 0]*xpos) * w, *int_limits)).astype(np.int64)
+    
+    # Integer part of the source coordinates (saturated to int16 like OpenCV does).
+    tab_bits = int(tab_size).bit_length() - 1
+    short_limits = (np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+    map1 = np.dstack((np.clip(x_fixed >> tab_bits, *short_limits),
+                      np.clip(y_fixed >> tab_bits, *short_limits))).astype(np.int16)
+    if tab_size == 1:
+        return map1, None
+    
+    # Fractional part of the source coordinates, as an index into the interpolation table.
+    map2 = ((y_fixed & (tab_size - 1))*tab_size + (x_fixed & (tab_size - 1))).astype(np.uint16)
+    return map1, map2
+
+# Define a class that holds everything needed to warp camera images for a fixed camera geometry.
+# The camera never moves relative to the rover, so this is built once and reused on every frame.
+class WarpCalibration():
+    # output_shape: shape of the warped images (same as the input images by default).
+    def __init__(self, img_shape, src, dst, output_shape=None):
+        self.img_shape = tuple(img_shape[:2])
+        self.output_shape = tuple(output_shape[:2]) if output_shape is not None else self.img_shape
+        self.source = np.float32(src)
+        self.destination = np.float32(dst)
+        
+        # Get a transformation matrix from the corners of the desired image section and a matrix containting the new image corner pixels.
+        self.trans_matrix = cv2.getPerspectiveTransform(self.source, self.destination)
+        _, inv_matrix = cv2.invert(self.trans_matrix)
+        
+        # Precomputed maps for bilinear (same as cv2.warpPerspective) and nearest-neighbour warping.
+        self.linear_map1, self.linear_map2 = _remap_tables(inv_matrix, self.output_shape, cv2.INTER_TAB_SIZE)
+        self.nearest_map, _ = _remap_tables(inv_matrix, self.output_shape, 1)
+        
+        # Footprint of the camera on the warped image: how much of each pixel is warped from inside the camera image
+        # (255 => all of it). The others are black fill, or blended with it on the edges of the footprint.
+        inside = np.full(self.img_shape, 255, dtype=np.uint8)
+        self.linear_footprint = self.warp(inside)
+        self.nearest_footprint = self.warp(inside, nearest=True)
+        self.label_masks = {}
+    
+    # Define a function to get the (cached) label mask of the valid pixels of the warped images (see TerrainClassifier.masks):
+    # outside the footprint, a pixel belongs to no class. On its blended edges and further than max_dist pixels
+    # from the rover (rover-centric distance, None => no limit), a pixel can't be an obstacle: the black fill darkens
+    # the edges, and the obstacles are only used for mapping (the bright classes are kept for the decision step).
+    def label_mask(self, nearest=False, max_dist=None):
+        key = (nearest, max_dist)
+        if key not in self.label_masks:
+            footprint = self.nearest_footprint if nearest else self.linear_footprint
+            label_mask = np.where(footprint > 0, 255 & ~1, 0).astype(np.uint8) # Obstacles are class 0
+            obstacles = footprint == 255
+            if max_dist is not None:
+                obstacles &= get_coordinate_tables(self.output_shape).dist.reshape(self.output_shape) <= max_dist
+            label_mask[obstacles] = 255
+            self.label_masks[key] = label_mask
+        return self.label_masks[key]
+    
+    # dst: optional output array (of the warped image shape) to write the warped image to.
+    def warp(self, img, nearest=False, dst=None):
+        if nearest:
+            return cv2.remap(img, self.nearest_map, None, cv2.INTER_NEAREST, dst=dst)
+        return cv2.remap(img, self.linear_map1, self.linear_map2, cv2.INTER_LINEAR, dst=dst)
+
+# Calibrations already built, keyed by the image shape and the transform parameters.
+_calibrations = {}
+
+# Define a function to get the (cached) calibration of the rover camera.
+# Camera images decoded at a reduced resolution are warped to the same (full resolution) warped image,
+# so the rest of the perception step doesn't depend on the decoding resolution.
+# reduction: warp to a warped image `reduction` times smaller in each dimension (dst_size and bottom_offset
+# are scaled down with it, so a meter is 2*dst_size/reduction pixels).
+def get_calibration(img_shape, dst_size=5, bottom_offset=10, reduction=1):
+    key = (tuple(img_shape[:2]), dst_size, bottom_offset, reduction)
+    if key not in _calibrations:
+        # Scale the source points (given for a CAMERA_SHAPE image) to the image size, pixel centers staying aligned.
+        img_scale = np.float64([img_shape[1] / CAMERA_SHAPE[1], img_shape[0] / CAMERA_SHAPE[0]])
+        source = (CALIBRATION_SOURCE + 0.5) * img_scale - 0.5
+        output_shape = (CAMERA_SHAPE[0] // reduction, CAMERA_SHAPE[1] // reduction)
+        destination = destination_points(output_shape, dst_size / reduction, bottom_offset / reduction)
+        _calibrations[key] = WarpCalibration(img_shape, source, destination, output_shape)
+    return _calibrations[key]
+
+def perspect_transform(img, src, dst, nearest=False):
+    # The transformation only depends on the image shape and the source/destination points, so build it once per combination.
+    src, dst = np.float32(src), np.float32(dst)
+    key = (tuple(img.shape[:2]), src.tobytes(), dst.tobytes())
+    if key not in _calibrations:
+        _calibrations[key] = WarpCalibration(img.shape, src, dst)
+    
+    # The output image has the same size as the input image.
+    return _calibrations[key].warp(img, nearest)
+
+
+# Define a class holding what the rover sees in a camera frame (see observe_frame)
+class FrameObservation():
+    def __init__(self, threshed, nav_dists, nav_angles, rock_dist, rock_angles, nav_hist, rock_hist,
+                 nav_cells, nav_hits, obs_cells, obs_hits, rock_cells):
+        self.threshed = threshed       # Binary masks of the warped image (channels: obstacles, rock samples, navigable terrain)
+        self.nav_dists = nav_dists     # Polar coordinates of the navigable terrain pixels
+        self.nav_angles = nav_angles
+        self.rock_dist = rock_dist     # Polar coordinates of the rock sample pixels
+        self.rock_angles = rock_angles
+        self.nav_hist = nav_hist       # Angular histograms of the navigable terrain and rock sample pixels
+        self.rock_hist = rock_hist
+        self.nav_cells = nav_cells     # Worldmap cells (flat indices) hit by navigable terrain pixels
+        self.nav_hits = nav_hits       # and the number of pixels landing on each of them
+        self.obs_cells = obs_cells     # Same for the obstacle pixels
+        self.obs_hits = obs_hits
+        self.rock_cells = rock_cells   # Worldmap cells hit by rock sample pixels
+
+# Define a function to find what the rover sees in a camera image taken at (xpos, ypos) with a given yaw.
+# This only depends on the image and the rover pose (no Rover state), so it can be applied to recorded frames in any order.
+# reduction: process a warped image `reduction` times smaller in each dimension (about reduction^2 times cheaper).
+# The distances, histograms and hit counts are scaled back to the full resolution ones (so the decision thresholds
+# still apply), and threshed is the reduced resolution masks.
+# Only the pixels inside the camera footprint are classified (the black fill and its blended edges aren't obstacles), and
+# with a max_range (meters from the bottom center of the warped image, None => no limit), only the pixels within
+# that range are mapped (the far pixels are the least precise ones). The decision inputs cover the whole footprint.
+def observe_frame(image, xpos, ypos, yaw, world_size, nearest=False, reduction=1, max_range=None):
+    ## 1) Get the perspective transform calibration (source and destination points, precomputed warp maps)
     dst_size = 5
     # Set a bottom offset to account for the fact that the bottom of the image
     # is not the position of the rover but a bit in front of it
     # this is just a rough guess, feel free to change it!
     bottom_offset = 10
-    
-    # The pixel coordinates below are found by opening `example_grid1.jpg` with paint and hovering over the grid corners
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]]) # (B)ottom (L)eft, BR, TR, TL
-    
-    destination = np.float32([[image.shape[1]/2 - dst_size, image.shape[0] - bottom_offset],    # Y-size center - dst_size, X-size - btm_offset
-                    [image.shape[1]/2 + dst_size, image.shape[0] - bottom_offset],              # Y-size center + dst_size, X-size - btm_offset
-                    [image.shape[1]/2 + dst_size, image.shape[0] - 2*dst_size - bottom_offset], # Y-size center + dst_size, X-size - 2*dst_size - btm_offset
-                    [image.shape[1]/2 - dst_size, image.shape[0] - 2*dst_size - bottom_offset], # Y-size center - dst_size, X-size - 2*dst_size - btm_offset
-                    ])
+    calibration = get_calibration(image.shape, dst_size, bottom_offset, reduction)
+    # Number of warped image pixels per meter (worldmap cell)
+    scale = 2 * dst_size / reduction
+    max_dist = max_range * scale if max_range is not None else None
     
     ## 2) Apply perspective transform
-    warped = perspect_transform(image, source, destination)
+    warped = calibration.warp(image, nearest=nearest)
     
     ## 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    nav_terrain_threshed = color_thresh(warped, rgb_thresh_min=(190, 180, 165), rgb_thresh_max=(255, 255, 230))
-    obs_threshed   = color_thresh(warped, rgb_thresh_min=(0, 0, 0), rgb_thresh_max=(160, 160, 160))
-    
-    # Rocks are bright in red and green channels, and dim in blue channel
-    # rock_threshed  = color_thresh(warped, rgb_thresh_min=(150, 100, 0), rgb_thresh_max=(255, 200, 80))
-    rock_threshed  = color_thresh(warped, rgb_thresh_min=(140, 115, 0), rgb_thresh_max=(255, 200, 80))
-    
-    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-    Rover.vision_image[:, :, 0] = obs_threshed*255
-    Rover.vision_image[:, :, 1] = rock_threshed*255
-    Rover.vision_image[:, :, 2] = nav_terrain_threshed*255
+    # The classes are in the same order as the channels of Rover.vision_image.
+    classifier = get_classifier([((0, 0, 0), (160, 160, 160)),          # Obstacles
+                                 # Rocks are bright in red and green channels, and dim in blue channel
+                                 # ((150, 100, 0), (255, 200, 80))
+                                 ((140, 115, 0), (255, 200, 80)),       # Rock samples
+                                 ((190, 180, 165), (255, 255, 230)),    # Navigable terrain
+                                 ])
+    threshed = classifier.masks(warped, calibration.label_mask(nearest, max_dist))
+    obs_threshed = threshed[:, :, 0]
+    rock_threshed = threshed[:, :, 1]
+    nav_terrain_threshed = threshed[:, :, 2]
     
     # 5) Convert map image pixel values to rover-centric coords
-    xpix, ypix = rover_coords(nav_terrain_threshed)
-    obs_xpix, obs_ypix = rover_coords(obs_threshed)
-    rock_xpix, rock_ypix = rover_coords(rock_threshed)
+    coord_tables = get_coordinate_tables(warped.shape)
+    nav_idx = coord_tables.pixel_indices(nav_terrain_threshed)
+    obs_idx = coord_tables.pixel_indices(obs_threshed)
+    rock_idx = coord_tables.pixel_indices(rock_threshed)
+    # The obstacles out of range are already masked out, the navigable terrain and rocks pixels are still needed
+    # for the decision step.
+    nav_map_idx, rock_map_idx = nav_idx, rock_idx
+    if max_dist is not None:
+        nav_map_idx = coord_tables.within_range(nav_idx, max_dist)
+        rock_map_idx = coord_tables.within_range(rock_idx, max_dist)
+    xpix, ypix = coord_tables.rover_coords(nav_map_idx)
+    obs_xpix, obs_ypix = coord_tables.rover_coords(obs_idx)
+    rock_xpix, rock_ypix = coord_tables.rover_coords(rock_map_idx)
     
     # 6) Convert rover-centric pixel values to world coordinates
-    xpos, ypos, yaw = Rover.pos[0], Rover.pos[1], Rover.yaw
-    world_size = Rover.worldmap.shape[0]
-    scale = 2 * dst_size
     x_world, y_world = pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale)
     obs_x_world, obs_y_world = pix_to_world(obs_xpix, obs_ypix, xpos, ypos, yaw, world_size, scale)
     rock_x_world, rock_y_world = pix_to_world(rock_xpix, rock_ypix, xpos, ypos, yaw, world_size, scale)
     
+    # Worldmap cells hit by each class of pixels
+    map_shape = (world_size, world_size)
+    nav_cells, nav_hits = count_hits(map_shape, x_world, y_world)
+    obs_cells, obs_hits = count_hits(map_shape, obs_x_world, obs_y_world)
+    rock_cells, _ = count_hits(map_shape, rock_x_world, rock_y_world)
     
     # 7) Convert rover-centric pixel positions to polar coordinates
-    Rover.nav_dists, Rover.nav_angles = to_polar_coords(xpix, ypix)
-    Rover.rock_dist, Rover.rock_angles = to_polar_coords(rock_xpix, rock_ypix)
-    
+    nav_dists, nav_angles = coord_tables.polar_coords(nav_idx)
+    rock_dist, rock_angles = coord_tables.polar_coords(rock_idx)
+    nav_hist = coord_tables.angular_histogram(nav_idx)
+    rock_hist = coord_tables.angular_histogram(rock_idx)
+    if reduction > 1:
+        nav_dists, rock_dist = nav_dists * reduction, rock_dist * reduction
+        nav_hist, rock_hist = nav_hist.scaled(reduction), rock_hist.scaled(reduction)
+        nav_hits, obs_hits = nav_hits * reduction**2, obs_hits * reduction**2
+    
+    return FrameObservation(threshed, nav_dists, nav_angles, rock_dist, rock_angles, nav_hist, rock_hist,
+                            nav_cells, nav_hits, obs_cells, obs_hits, rock_cells)
+
+# Define a function to apply the perception steps to a batch of frames at once (for replay and evaluation).
+# frames: (N, height, width, 3) camera images, positions: (N, 2) rover (x, y) positions, yaws: (N,) yaw angles.
+# The nav/obstacle/rock pixels of all the frames are accumulated into `worldmap` (a new one by default) like
+# update_worldmap does (+7 per navigable terrain hit, +2 per obstacle hit, 255 for rocks, saturating), but without
+# the Rover state dependent parts (mapping delay/conditions, red channel reset, periodic clean up).
+# The frames are processed in blocks of block_size frames (the per-pixel arrays of a block stay in the CPU caches).
+# Like observe_frame, only the pixels inside the camera footprint, and within max_range meters when given, are mapped.
+# Returns the worldmap, and if return_polar is True, a list with (nav_dists, nav_angles, rock_dist, rock_angles) for each frame.
+def perception_batch(frames, positions, yaws, worldmap=None, return_polar=False, nearest=False, stats=None, block_size=16,
+                     max_range=None):
+    frames = np.asarray(frames)
+    positions = np.asarray(positions, dtype=np.float64)
+    yaws = np.asarray(yaws, dtype=np.float64)
+    if worldmap is None:
+        worldmap = create_worldmap(200)
+    world_size = worldmap.shape[0]
+    map_cells = worldmap.shape[0] * worldmap.shape[1]
     
+    dst_size = 5
+    bottom_offset = 10
+    scale = 2 * dst_size
+    calibration = get_calibration(frames.shape[1:3], dst_size, bottom_offset)
+    classifier = get_classifier([((0, 0, 0), (160, 160, 160)),          # Obstacles
+                                 ((140, 115, 0), (255, 200, 80)),       # Rock samples
+                                 ((190, 180, 165), (255, 255, 230)),    # Navigable terrain
+                                 ])
+    coord_tables = get_coordinate_tables(calibration.output_shape)
+    frame_pixels = calibration.output_shape[0] * calibration.output_shape[1]
+    max_dist = max_range * scale if max_range is not None else None
+    label_mask = calibration.label_mask(nearest, max_dist)
+    
+    # Rotation of each frame
+    yaws_rad = yaws * np.pi / 180
+    cos_yaws, sin_yaws = np.cos(yaws_rad), np.sin(yaws_rad)
+    
+    # Number of hits of each worldmap cell for each class (obstacles, rock samples, navigable terrain).
+    # A TiledWorldmap can be much larger than the explored area, its hits are counted block by block instead
+    # (list of (cells, hits) for each class) and merged at the end.
+    tiled = isinstance(worldmap, TiledWorldmap)
+    class_hits = [[], [], []] if tiled else np.zeros((3, map_cells), dtype=np.int64)
+    polar = []
+    warped = np.empty((block_size,) + calibration.output_shape + (3,), dtype=np.uint8)
+    for start in range(0, len(frames), block_size):
+        stop = min(start + block_size, len(frames))
+        
+        # 1) and 2) Perspective transform of the frames of the block
+        for idx in range(start, stop):
+            calibration.warp(frames[idx], nearest=nearest, dst=warped[idx - start])
+        
+        # 3) Color thresholds, the frames are stacked vertically to classify them in one call
+        labels = classifier.labels(warped[:stop - start].reshape(-1, calibration.output_shape[1], 3))
+        # Only the valid pixels of each frame keep their classes (see WarpCalibration.label_mask)
+        frame_labels = labels.reshape((stop - start,) + calibration.output_shape)
+        np.bitwise_and(frame_labels, label_mask, out=frame_labels)
+        
+        # 5) and 6) Rover-centric then world coordinates of the pixels of each class, for all the frames of the block.
+        # Same computation as pix_to_world, with the rotation/translation of each frame repeated for each of its pixels.
+        block_pixels = []
+        for class_idx in range(3):
+            frame_idx, pixel_idx = np.divmod(np.flatnonzero(labels & (1 << class_idx)), frame_pixels)
+            frame_counts = np.bincount(frame_idx, minlength=stop - start)
+            block_pixels.append((pixel_idx, np.concatenate(([0], np.cumsum(frame_counts)))))
+            # The navigable terrain and rocks out of range are only used for the polar coordinates
+            if max_dist is not None and class_idx != 0:
+                in_range = coord_tables.dist[pixel_idx] <= max_dist
+                frame_idx, pixel_idx = frame_idx[in_range], pixel_idx[in_range]
+                frame_counts = np.bincount(frame_idx, minlength=stop - start)
+            xpix, ypix = coord_tables.rover_coords(pixel_idx)
+            cos_yaw = np.repeat(cos_yaws[start:stop], frame_counts)
+            sin_yaw = np.repeat(sin_yaws[start:stop], frame_counts)
+            x_world = (xpix * cos_yaw - ypix * sin_yaw) / scale + np.repeat(positions[start:stop, 0], frame_counts)
+            y_world = (xpix * sin_yaw + ypix * cos_yaw) / scale + np.repeat(positions[start:stop, 1], frame_counts)
+            
+            # Flat worldmap cells hit by the pixels (with the same clipping as pix_to_world)
+            cells = np.clip(np.int_(y_world), 0, world_size - 1) * worldmap.shape[1] + np.clip(np.int_(x_world), 0, world_size - 1)
+            if tiled:
+                class_hits[class_idx].append(np.unique(cells, return_counts=True))
+            else:
+                class_hits[class_idx] += np.bincount(cells, minlength=map_cells)
+        
+        # 7) Polar coordinates of the navigable terrain and rock sample pixels, split by frame
+        # (pixels are sorted by frame, so each frame is a contiguous slice)
+        if return_polar:
+            (rock_pixel_idx, rock_bounds), (nav_pixel_idx, nav_bounds) = block_pixels[1], block_pixels[2]
+            nav_dists, nav_angles = coord_tables.polar_coords(nav_pixel_idx)
+            rock_dist, rock_angles = coord_tables.polar_coords(rock_pixel_idx)
+            for idx in range(stop - start):
+                nav_slice = slice(nav_bounds[idx], nav_bounds[idx + 1])
+                rock_slice = slice(rock_bounds[idx], rock_bounds[idx + 1])
+                polar.append((nav_dists[nav_slice], nav_angles[nav_slice], rock_dist[rock_slice], rock_angles[rock_slice]))
+    
+    # 8) Accumulate the hits of all the frames into the worldmap
+    for class_idx, increment in ((2, 7), (0, 2), (1, None)):
+        if tiled:
+            cells, hits = merge_hits(class_hits[class_idx])
+        else:
+            cells = np.flatnonzero(class_hits[class_idx])
+            hits = class_hits[class_idx][cells]
+        if increment is None:
+            write_cells(worldmap, class_idx, cells, 255, stats)
+        else:
+            add_hits(worldmap, class_idx, cells, hits, increment, stats=stats)
+    
+    if return_polar:
+        return worldmap, polar
+    return worldmap
+
+# Define a function to merge a list of (cells, hits) pairs (distinct cells in each pair) into the distinct cells and their total hits
+def merge_hits(cell_hits):
+    if len(cell_hits) == 0:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.int64)
+    cells, inverse = np.unique(np.concatenate([cells for cells, _ in cell_hits]), return_inverse=True)
+    hits = np.bincount(inverse, weights=np.concatenate([hits for _, hits in cell_hits]), minlength=len(cells))
+    return cells, hits.astype(np.int64)
+
+# Define a function to update the Rover worldmap with what has been observed on the current frame.
+# The update depends on the Rover state (and the worldmap itself), so frames must be applied in order.
+# update_map: update the navigable terrain and obstacles channels (the expensive part). Without it, the rest of the
+# per-frame state (starting delay, rock samples, exploration planner, iteration counter) is still updated.
+def update_worldmap(Rover, observation, update_map=True):
     # 8) Update Rover worldmap (to be displayed on right side of screen)
     # Update world map if we are not turning around or tilted more than 5 degrees to ensure good precision.
     # Roll angle can be described as the rotation of an object around its longitudinal axis (side-to-side).
     # Pitch angle can be described as the rotation (flipping) of an object due to acceleration (front-to-rear).
+    # With an occupancy grid (see OccupancyGrid), the navigable terrain and obstacles channels are derived from it.
+    occupancy = Rover.occupancy
     if Rover.starting_counter <= 120:
-        print(f"Starting the simulation. Delayed mapping: no mapping is done. Frames until the end of the delay: {Rover.starting_counter}/120\r", end="")
+        Rover.events.log(events.STARTING_DELAY, Rover, Rover.starting_counter)
         Rover.starting_counter += 1
         Rover.throttle_set = 0.3
         if Rover.starting_counter == 121:
             Rover.throttle_set = 0.7
-            print("\n")
+            Rover.events.log(events.MAPPING_STARTED, Rover)
     
-    elif ((0 <= Rover.roll  < 2) or (360 >= Rover.roll > 358)) and \
+    elif update_map and ((0 <= Rover.roll  < 2) or (360 >= Rover.roll > 358)) and \
         ((0 <= Rover.pitch <= 1) or (360 >= Rover.pitch >= 359)) and \
             not Rover.send_pickup and \
             not Rover.brake and \
@@ -171,40 +581,61 @@ def perception_step(Rover):
         # not (Rover.rock_detected and (Rover.roll > 2 or Rover.roll)) 
         # Check for pixels with value > 255 => Rover.worldmap[Rover.worldmap[: , :, 0] > 255, 0] = 255
         
-        # Reset the red channel where there are blue pixels.
-        Rover.worldmap[Rover.worldmap[:, :, 2] > 160, 0] = 0
-        if Rover.mode != 'stuck':
-            # Update blue channel where there is navigable terrain
-            Rover.worldmap[y_world, x_world, 2] += 7
-            
-            # make sure all blue pixels don't exceed 255:
-            Rover.worldmap[Rover.worldmap[:, :, 2] > 255, 2] = 255
+        if occupancy is not None:
+            # Navigable terrain evidence of the observed cells (the obstacles evidence is fused in the same log-odds).
+            if Rover.mode != 'stuck':
+                occupancy.add_evidence(observation.nav_cells, occupancy.nav_increment)
+        else:
+            # Reset the red channel where there are blue pixels.
+            cell_values = map_values(Rover.worldmap)
+            set_masked(Rover.worldmap, 0, (cell_values[:, 2] > 160) & (cell_values[:, 0] > 0), 0, Rover.map_stats)
+            if Rover.mode != 'stuck':
+                # Update blue channel where there is navigable terrain (saturates at 255).
+                add_hits(Rover.worldmap, 2, observation.nav_cells, observation.nav_hits, 7, stats=Rover.map_stats)
     
     # Update red channel where there are obstacles.
-    Rover.worldmap[obs_y_world, obs_x_world, 0] += 2
+    if not update_map:
+        pass
+    elif occupancy is not None:
+        occupancy.add_evidence(observation.obs_cells, -occupancy.obs_increment)
+        occupancy.flush(Rover.worldmap, Rover.map_stats)
+    else:
+        add_hits(Rover.worldmap, 0, observation.obs_cells, observation.obs_hits, 2, stats=Rover.map_stats)
+    # The evidence of the occupancy grid fades with the frames, whether the map has been updated or not
+    if occupancy is not None:
+        occupancy.tick()
     
     # Update green channel where there are rocks.
-    Rover.worldmap[rock_y_world, rock_x_world, 1] = 255
+    rock_cells = write_cells(Rover.worldmap, 1, observation.rock_cells, 255, Rover.map_stats)
+    
+    # Check whether the rock detections confirm any of the known sample positions.
+    if Rover.sample_locator is not None:
+        Rover.sample_locator.add_rock_cells(rock_cells)
+        Rover.samples_located = Rover.sample_locator.located_count
     
     
     # Clear out low certainty navigable terrain pixels every 100 frames to increase fidelity.
-    if Rover.iteration_counter % 100 == 0:
-        # Find navigable terrain pixels
-        nav_terrain_pixels = Rover.worldmap[:, :, 2] > 0
-        
-        # Define low certainty pixel as having a value less than one-fourth of the average.
-        # Set low quality pixels to zero.
-        if nav_terrain_pixels.any():
-            low_certainty_pixel_value = np.mean(Rover.worldmap[nav_terrain_pixels, 2]) / 4
-            low_certainty_pixels = Rover.worldmap[:, :, 2] < max(low_certainty_pixel_value, 100)
-            Rover.worldmap[low_certainty_pixels, 2] = 0
-            
-            print("\nMean blue pixles value:", int(low_certainty_pixel_value*4))
-            
-            # # Do the opposite of the above; set the hight certainty navigable terrain pixels to 255
-            # high_certainty_pixels = Rover.worldmap[:, :, 2] > 50
-            # Rover.worldmap[high_certainty_pixels, 2] = 255
+    # (not needed with an occupancy grid, low certainty cells are never shown as navigable terrain)
+    # Without a map update, the clean up waits for the next 100th frame.
+    if update_map and Rover.iteration_counter % 100 == 0:
+        if occupancy is None:
+            # Find navigable terrain pixels
+            nav_values = map_values(Rover.worldmap)[:, 2]
+            nav_terrain_pixels = nav_values > 0
             
+            # Define low certainty pixel as having a value less than one-fourth of the average.
+            # Set low quality pixels to zero.
+            if nav_terrain_pixels.any():
+                low_certainty_pixel_value = np.mean(nav_values[nav_terrain_pixels]) / 4
+                low_certainty_pixels = nav_values < max(low_certainty_pixel_value, 100)
+                set_masked(Rover.worldmap, 2, low_certainty_pixels & nav_terrain_pixels, 0, Rover.map_stats)
+                
+                Rover.events.log(events.MAP_CLEANUP, Rover, int(low_certainty_pixel_value*4))
+                
+                # # Do the opposite of the above; set the hight certainty navigable terrain pixels to 255
+                # high_certainty_pixels = Rover.worldmap[:, :, 2] > 50
+                # Rover.worldmap[high_certainty_pixels, 2] = 255
+                
         # Reset the counter
         Rover.iteration_counter = 0
     
@@ -219,5 +650,47 @@ def perception_step(Rover):
     # Rover.nav_dists = rock_dist
     # Rover.nav_angles = rock_angles
     
+    # Update the exploration frontier and heading with the changes of the worldmap
+    if Rover.planner is not None:
+        Rover.planner.step(Rover.worldmap, Rover.pos[0], Rover.pos[1], Rover.yaw)
+    
     Rover.iteration_counter += 1
     return Rover
+
+# Define a function to apply the steps 1) to 7) to the current camera image and update the Rover inputs of the
+# decision step (vision image, polar coordinates and angular histograms). Returns the observation.
+def perceive(Rover, reduction=1):
+    # Perform perception steps to update Rover()
+    # NOTE: camera image is coming to you in Rover.img
+    # Steps 1) to 7) (see observe_frame)
+    observation = observe_frame(Rover.img, Rover.pos[0], Rover.pos[1], Rover.yaw, Rover.worldmap.shape[0], Rover.warp_nearest,
+                                reduction, Rover.map_range)
+    
+    # 4) Update Rover.vision_image (this will be displayed on left side of screen)
+    # Channel 0: obstacles, channel 1: rock samples, channel 2: navigable terrain.
+    if observation.threshed.shape == Rover.vision_image.shape:
+        Rover.vision_image[:, :, :] = observation.threshed*255
+    else:
+        vision_shape = Rover.vision_image.shape
+        Rover.vision_image[:, :, :] = cv2.resize(observation.threshed, (vision_shape[1], vision_shape[0]),
+                                                 interpolation=cv2.INTER_NEAREST)*255
+    
+    # 7) Polar coordinates of the navigable terrain and rock sample pixels
+    Rover.nav_dists, Rover.nav_angles = observation.nav_dists, observation.nav_angles
+    Rover.rock_dist, Rover.rock_angles = observation.rock_dist, observation.rock_angles
+    Rover.nav_hist, Rover.rock_hist = observation.nav_hist, observation.rock_hist
+    return observation
+
+# Apply the above functions in succession and update the Rover state accordingly
+# update_map, reduction: see update_worldmap and observe_frame (the decision inputs are updated either way).
+def perception_step(Rover, update_map=True, reduction=1):
+    # Make sure to not update the map at the start of the simulation to prevent wrong values.
+    # if s:=all([abs(abs(Rover.pos[0]) - 99.7) <= 1, abs(abs(Rover.pos[1]) - 85.6) <= 1]) and (Rover.samples_collected in [0, 6]):
+    #     print(f"Near the starting position of the simulation {s}. No mapping is done.")
+    #     return Rover
+    
+    observation = perceive(Rover, reduction)
+    
+    # 8) Update Rover worldmap (to be displayed on right side of screen)
+    update_worldmap(Rover, observation, update_map)
+    return Rover
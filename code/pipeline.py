@@ -0,0 +1,67 @@
+import traceback
+
+import eventlet
+import eventlet.queue
+import eventlet.tpool
+
+# Define a class for "latest frame wins" processing of the telemetry messages.
+# The socket handler only stores the newest frame (replacing the one waiting, if any),
+# and a worker loop always processes the most recent frame, so stale frames are dropped
+# instead of queueing up behind a slow frame and the control latency stays bounded.
+# The frames are processed in a thread of eventlet's thread pool: run in a green thread, the processing
+# would hold the hub until it is done, so the server would only read the next message after each frame
+# and there would never be a newer frame to replace the pending one.
+# process_frame: function called (in the thread pool) with (sid, data) of a frame, returns its reply.
+# deliver: function called (in the worker green thread) with (sid, reply) of the frames with a reply.
+class FramePipeline():
+    def __init__(self, process_frame, deliver=None):
+        self.process_frame = process_frame
+        self.deliver = deliver
+        self.pending = eventlet.queue.LightQueue(maxsize=1) # Holds the newest frame not processed yet
+        self.worker = None
+        
+        self.received_count = 0  # Number of frames received
+        self.processed_count = 0 # Number of frames processed
+        self.dropped_count = 0   # Number of frames replaced by a newer one before being processed
+    
+    # Start the worker loop (in a green thread).
+    def start(self):
+        if self.worker is None:
+            self.worker = eventlet.spawn(self._run)
+        return self
+    
+    # Stop the worker loop (the pending frame, if any, is dropped).
+    def stop(self):
+        if self.worker is not None:
+            self.worker.kill()
+            self.worker = None
+    
+    # Store a new frame, dropping the pending one if it hasn't been processed yet.
+    def submit(self, sid, data):
+        self.received_count += 1
+        try:
+            self.pending.get_nowait()
+            self.dropped_count += 1
+        except eventlet.queue.Empty:
+            pass
+        self.pending.put_nowait((sid, data))
+    
+    def counters(self):
+        return {'received': self.received_count,
+                'processed': self.processed_count,
+                'dropped': self.dropped_count,
+                'pending': self.pending.qsize()}
+    
+    def _run(self):
+        while True:
+            sid, data = self.pending.get()
+            try:
+                reply = eventlet.tpool.execute(self.process_frame, sid, data)
+                if reply is not None and self.deliver is not None:
+                    self.deliver(sid, reply)
+            except Exception:
+                # Don't let a bad frame stop the worker loop.
+                traceback.print_exc()
+            self.processed_count += 1
+            # Let the server receive the frames which arrived while processing this one.
+            eventlet.sleep(0)
@@ -0,0 +1,158 @@
+import numpy as np
+
+from worldmap import read_cells
+
+# Define a class suggesting an exploration heading from what the worldmap already knows, so the rover heads
+# towards the unexplored areas instead of driving again through the mapped corridors.
+# => The frontier is the set of the navigable terrain cells (nonzero navigable terrain channel) next to an unknown
+#    cell (navigable terrain and obstacles channels both zero). It is kept up to date from the cells whose
+#    navigable terrain/obstacles channels became zero/nonzero on the frame (recorded by the map statistics):
+#    only these cells and their neighbours can change their frontier status.
+# => Every replan_interval frames, a breadth-first wavefront is grown from the rover cell over the navigable
+#    terrain of a (2*radius+1)^2 window around the rover (never the whole map), until it reaches a frontier cell.
+#    The suggested heading points to the cell `lookahead` steps along the shortest path to it, or straight to
+#    the closest frontier cell of the whole map when none is reachable in the window.
+class FrontierPlanner():
+    def __init__(self, stats, radius=25, replan_interval=5, lookahead=8, steer_weight=0.5):
+        self.radius = radius
+        self.replan_interval = replan_interval
+        self.lookahead = lookahead
+        self.steer_weight = steer_weight # Weight of the heading in the steering, see decision.exploration_steer
+        self.frontier = set() # Flat indices of the frontier cells
+        self.frontier_array = None # Sorted array of the frontier cells (None => to be rebuilt from the set)
+        self.frame = 0
+        self.heading = None # Suggested heading, relative to the rover yaw (degrees, positive to the left), None => no frontier
+        self.target = None # (x, y) of the frontier cell the heading leads to
+        self.distance = None # Number of steps of the path to the target (None => straight line to a cell out of the window)
+        
+        # Record the cells whose navigable terrain/obstacles status changes
+        self.stats = stats
+        stats.changed_cells = []
+    
+    # Update the frontier, and the heading if it is due (call it once per frame, after the worldmap update).
+    def step(self, worldmap, xpos, ypos, yaw):
+        changed = self.stats.changed_cells
+        if changed:
+            self.update_frontier(worldmap, np.concatenate(changed))
+            changed.clear()
+        if self.frame % self.replan_interval == 0:
+            self.plan(worldmap, xpos, ypos, yaw)
+        self.frame += 1
+    
+    # Update the frontier status of the cells at the given flat indices and of their neighbours
+    def update_frontier(self, worldmap, cells):
+        cells = np.unique(np.concatenate((cells, neighbour_cells(cells, worldmap.shape))))
+        is_frontier = navigable(worldmap, cells) & has_unknown_neighbour(worldmap, cells)
+        self.frontier.difference_update(cells[~is_frontier].tolist())
+        self.frontier.update(cells[is_frontier].tolist())
+        self.frontier_array = None
+    
+    # Sorted array of the flat indices of the frontier cells
+    def frontier_cells(self):
+        if self.frontier_array is None:
+            self.frontier_array = np.sort(np.fromiter(self.frontier, dtype=np.intp, count=len(self.frontier)))
+        return self.frontier_array
+    
+    # Compute the heading towards the closest frontier cell
+    def plan(self, worldmap, xpos, ypos, yaw):
+        self.heading = self.target = self.distance = None
+        frontier = self.frontier_cells()
+        if len(frontier) == 0:
+            return
+        world_size = worldmap.shape[1]
+        rover_x = int(np.clip(xpos, 0, world_size - 1))
+        rover_y = int(np.clip(ypos, 0, worldmap.shape[0] - 1))
+        
+        # Window around the rover (clipped to the world)
+        x0, x1 = max(rover_x - self.radius, 0), min(rover_x + self.radius + 1, world_size)
+        y0, y1 = max(rover_y - self.radius, 0), min(rover_y + self.radius + 1, worldmap.shape[0])
+        window_y, window_x = np.mgrid[y0:y1, x0:x1]
+        cells = (window_y * world_size + window_x).ravel()
+        passable = navigable(worldmap, cells).reshape(window_y.shape)
+        is_frontier = np.isin(cells, frontier, assume_unique=True).reshape(window_y.shape)
+        
+        dists = wavefront(passable, (rover_y - y0, rover_x - x0), is_frontier)
+        reached = is_frontier & (dists >= 0)
+        if reached.any():
+            # The reached frontier cells are all at the same distance, take the one most in front of the rover
+            target_y, target_x = np.nonzero(reached)
+            turns = np.abs(relative_heading(target_x + x0 - xpos, target_y + y0 - ypos, yaw))
+            best = int(np.argmin(turns))
+            target_y, target_x = int(target_y[best]), int(target_x[best])
+            self.distance = int(dists[target_y, target_x])
+            way_y, way_x = backtrack(dists, target_y, target_x, self.lookahead)
+            self.target = (target_x + x0, target_y + y0)
+            self.heading = float(relative_heading(way_x + x0 + 0.5 - xpos, way_y + y0 + 0.5 - ypos, yaw))
+        else:
+            # No frontier reachable in the window: closest frontier cell of the whole map, in a straight line
+            frontier_y, frontier_x = np.divmod(frontier, world_size)
+            closest = int(np.argmin((frontier_x - xpos)**2 + (frontier_y - ypos)**2))
+            self.target = (int(frontier_x[closest]), int(frontier_y[closest]))
+            self.heading = float(relative_heading(self.target[0] + 0.5 - xpos, self.target[1] + 0.5 - ypos, yaw))
+
+# Define a function to get whether the cells at the given flat indices are known navigable terrain
+def navigable(worldmap, cells):
+    return read_cells(worldmap, 2, cells) > 0
+
+# Define a function to get whether the cells at the given flat indices have an unknown 4-neighbour in the world
+def has_unknown_neighbour(worldmap, cells):
+    world_height, world_width = worldmap.shape[:2]
+    cell_y, cell_x = np.divmod(cells, world_width)
+    result = np.zeros(len(cells), dtype=bool)
+    for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+        inside = (cell_x + dx >= 0) & (cell_x + dx < world_width) & (cell_y + dy >= 0) & (cell_y + dy < world_height)
+        neighbours = cells[inside] + dy * world_width + dx
+        unknown = (read_cells(worldmap, 2, neighbours) == 0) & (read_cells(worldmap, 0, neighbours) == 0)
+        result[inside] |= unknown
+    return result
+
+# Define a function to get the flat indices of the 4-neighbours (in the world) of the cells at the given flat indices
+def neighbour_cells(cells, shape):
+    world_height, world_width = shape[:2]
+    cell_y, cell_x = np.divmod(cells, world_width)
+    neighbours = []
+    for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+        inside = (cell_x + dx >= 0) & (cell_x + dx < world_width) & (cell_y + dy >= 0) & (cell_y + dy < world_height)
+        neighbours.append(cells[inside] + dy * world_width + dx)
+    return np.concatenate(neighbours)
+
+# Define a function to grow a breadth-first wavefront (4-connected) from `start` over the passable cells of a window,
+# until it reaches a cell of `targets` (the start cell is always passable).
+# Returns the number of steps to each reached cell (-1 for the cells not reached).
+def wavefront(passable, start, targets):
+    dists = np.full(passable.shape, -1, dtype=np.int32)
+    dists[start] = 0
+    reached = np.zeros(passable.shape, dtype=bool)
+    reached[start] = True
+    front = reached.copy()
+    grown = np.empty_like(front)
+    step = 0
+    while front.any() and not (front & targets).any():
+        step += 1
+        grown[:] = False
+        grown[1:] |= front[:-1]
+        grown[:-1] |= front[1:]
+        grown[:, 1:] |= front[:, :-1]
+        grown[:, :-1] |= front[:, 1:]
+        grown &= passable
+        grown &= ~reached
+        reached |= grown
+        dists[grown] = step
+        front, grown = grown, front
+    return dists
+
+# Define a function to walk back from a cell of a wavefront (see wavefront) towards its start,
+# returns the (y, x) of the cell of the path at `steps` steps from the start (or the cell itself if it is closer).
+def backtrack(dists, y, x, steps):
+    height, width = dists.shape
+    while dists[y, x] > steps:
+        for dy, dx in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            if 0 <= y + dy < height and 0 <= x + dx < width and dists[y + dy, x + dx] == dists[y, x] - 1:
+                y, x = y + dy, x + dx
+                break
+    return y, x
+
+# Define a function to convert world offsets to a heading relative to the rover yaw (degrees in [-180, 180), positive to the left)
+def relative_heading(dx, dy, yaw):
+    heading = np.arctan2(dy, dx) * 180/np.pi - yaw
+    return (heading + 180) % 360 - 180
@@ -0,0 +1,131 @@
+import os
+import csv
+import queue
+import threading
+from datetime import datetime
+
+import numpy as np
+import cv2
+
+# Header of the recording log, same format as test_dataset/robot_log.csv
+LOG_HEADER = ['Path', 'SteerAngle', 'Throttle', 'Brake', 'Speed', 'X_Position', 'Y_Position', 'Pitch', 'Yaw', 'Roll']
+
+# Define a class to record the camera frames of a run in a background thread.
+# Frames are handed over through a bounded queue, so the control loop never waits for the
+# file system (unless when_full='block'). The recording is written in `folder` as:
+# => robot_log.csv: one line per frame, same format as test_dataset/robot_log.csv.
+# => IMG/: the frames, either as the JPEG images received from the simulator (container='jpg')
+#    or as chunks of `chunk_size` RGB frames saved as .npy files (container='npy'). In that case
+#    the Path of a frame is "<chunk file>:<index in the chunk>" (see load_frame).
+class FrameRecorder():
+    def __init__(self, folder, container='jpg', queue_size=256, when_full='drop', chunk_size=256):
+        if container not in ('jpg', 'npy'):
+            raise ValueError("container must be 'jpg' or 'npy'")
+        if when_full not in ('drop', 'block'):
+            raise ValueError("when_full must be 'drop' or 'block'")
+        self.folder = folder
+        self.container = container
+        self.when_full = when_full # What to do when the queue is full: 'drop' the frame or 'block' until there is room
+        self.chunk_size = chunk_size
+        
+        self.recorded_count = 0 # Number of frames queued for writing
+        self.dropped_count = 0  # Number of frames dropped because the queue was full
+        self.written_count = 0  # Number of frames written
+        
+        self.images_folder = os.path.join(folder, 'IMG')
+        os.makedirs(self.images_folder, exist_ok=True)
+        self.log_file = open(os.path.join(folder, 'robot_log.csv'), 'w', newline='')
+        self.log_writer = csv.writer(self.log_file, delimiter=';')
+        self.log_writer.writerow(LOG_HEADER)
+        
+        self.chunk = [] # Frames of the current (not yet written) chunk
+        self.chunk_count = 0
+        
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run, name='FrameRecorder', daemon=True)
+        self.thread.start()
+    
+    # Queue the current frame of the Rover for writing. Returns False if the frame has been dropped.
+    def record(self, Rover, frame):
+        timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+        values = (Rover.steer, Rover.throttle, Rover.brake, Rover.vel,
+                  Rover.pos[0], Rover.pos[1], Rover.pitch, Rover.yaw, Rover.roll)
+        if self.container == 'jpg':
+            # The JPEG image as received, no need to encode it again.
+            image = frame.jpeg_bytes
+        else:
+            # Rover.img is reused by the next frame, so keep a copy.
+            image = np.array(Rover.img)
+        
+        # The sequence number keeps the file names distinct when several frames are recorded in the same millisecond.
+        item = (timestamp, self.recorded_count, image, values)
+        if self.when_full == 'block':
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                self.dropped_count += 1
+                return False
+        self.recorded_count += 1
+        return True
+    
+    # Write all the queued frames and close the recording.
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, sequence, image, values = item
+            if self.container == 'jpg':
+                path = os.path.join(self.images_folder, 'robocam_{}_{:06d}.jpg'.format(timestamp, sequence))
+                with open(path, 'wb') as image_file:
+                    image_file.write(image)
+                self._write_log(path, values)
+                if (self.written_count + 1) % self.chunk_size == 0:
+                    self.log_file.flush()
+            else:
+                self.chunk.append((image, values))
+                if len(self.chunk) >= self.chunk_size:
+                    self._write_chunk()
+            self.written_count += 1
+        
+        # Flush what is left.
+        if self.chunk:
+            self._write_chunk()
+        self.log_file.close()
+    
+    def _write_chunk(self):
+        path = os.path.join(self.images_folder, 'frames_{:05d}.npy'.format(self.chunk_count))
+        np.save(path, np.stack([image for image, _ in self.chunk]))
+        for idx, (_, values) in enumerate(self.chunk):
+            self._write_log('{}:{}'.format(path, idx), values)
+        self.log_file.flush()
+        self.chunk = []
+        self.chunk_count += 1
+    
+    def _write_log(self, path, values):
+        self.log_writer.writerow([path] + [repr(float(value)) for value in values])
+
+# Chunks of frames already loaded (memory mapped), keyed by their path.
+_chunks = {}
+
+# Define a function to load a recorded frame (RGB) given its Path in the recording log.
+# Paths of frames saved in .npy chunks are "<chunk file>:<index in the chunk>".
+def load_frame(path):
+    chunk_path, _, idx = path.rpartition(':')
+    if chunk_path.endswith('.npy') and idx.isdigit():
+        if chunk_path not in _chunks:
+            _chunks.clear() # Only keep the last chunk in memory (frames are usually read in order)
+            _chunks[chunk_path] = np.load(chunk_path, mmap_mode='r')
+        return np.array(_chunks[chunk_path][int(idx)])
+    
+    bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+    if bgr is None:
+        raise IOError("Can't read image {}".format(path))
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,189 @@
+import os
+import re
+import csv
+import base64
+import argparse
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy as np
+import cv2
+
+from events import QUIET
+from perception import observe_frame, update_worldmap
+from recorder import load_frame
+from planner import FrontierPlanner
+from worldmap import create_occupancy_grid, MapStatistics, TiledWorldmap, create_worldmap, map_region
+from supporting_functions import convert_to_float, render_map
+
+# Replay a recorded run (a robot_log.csv and its images) through the perception step to build its worldmap.
+# Observing the frames (perspective transform, thresholding, coordinate transforms) is the expensive part and
+# doesn't depend on the Rover state, so it runs in a pool of worker processes, chunk by chunk. The worldmap
+# updates depend on the current worldmap (red channel reset, periodic clean up...), so the observations are
+# applied in the order of the log, giving exactly the same worldmap as a serial run.
+# Example: $ python replay.py ../test_dataset/robot_log.csv --workers 4 --output ../output/replay_map.png
+
+# Define a function to sort file names in natural order (frame2.jpg before frame10.jpg)
+def natural_key(name):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+# Define a function to find the image of a log line. Paths are usually relative to the code folder
+# (like in test_dataset/robot_log.csv), otherwise look for the image in the IMG folder next to the log.
+def resolve_path(path, log_folder):
+    # Frames saved in .npy chunks have a "<chunk file>:<index in the chunk>" path.
+    chunk_path, _, idx = path.rpartition(':')
+    file_path = chunk_path if chunk_path.endswith('.npy') and idx.isdigit() else path
+    if os.path.exists(file_path):
+        return path
+    return os.path.join(log_folder, 'IMG', os.path.basename(path.replace('\\', '/')))
+
+# Define a generator of the frames of a recording log, in the order of the log.
+# If images_folder is given, its images (in natural order) are used instead of the Path column
+# (like the notebook does for the frames of test_dataset/dummy-video-frames).
+def read_log(csv_file, images_folder=None):
+    log_folder = os.path.dirname(csv_file)
+    if images_folder is not None:
+        images = iter([os.path.join(images_folder, name) for name in sorted(os.listdir(images_folder), key=natural_key)
+                       if not name.startswith('.')])
+    
+    with open(csv_file, newline='') as log_file:
+        for line in csv.DictReader(log_file, delimiter=';'):
+            if images_folder is not None:
+                path = next(images, None)
+                if path is None:
+                    return
+            else:
+                path = resolve_path(line['Path'], log_folder)
+            
+            yield {'path': path,
+                   'steer': convert_to_float(line['SteerAngle']),
+                   'throttle': convert_to_float(line['Throttle']),
+                   'brake': convert_to_float(line['Brake']),
+                   'vel': convert_to_float(line['Speed']),
+                   'pos': (convert_to_float(line['X_Position']), convert_to_float(line['Y_Position'])),
+                   'pitch': convert_to_float(line['Pitch']),
+                   'yaw': convert_to_float(line['Yaw']),
+                   'roll': convert_to_float(line['Roll'])}
+
+# Define a function to build the telemetry message the simulator would send for a frame of a recording.
+# The sample positions aren't part of the recording, the default ones are made up.
+def telemetry_message(frame, samples_x='100;104;62;150;170;10', samples_y='90;95;110;140;160;20'):
+    with open(frame['path'], 'rb') as image_file:
+        image_string = base64.b64encode(image_file.read()).decode('utf-8')
+    return {'speed': str(frame['vel']), 'position': '{};{}'.format(*frame['pos']),
+            'yaw': str(frame['yaw']), 'pitch': str(frame['pitch']), 'roll': str(frame['roll']),
+            'throttle': str(frame['throttle']), 'steering_angle': str(frame['steer']), 'brake': str(frame['brake']),
+            'near_sample': '0', 'picking_up': '0', 'sample_count': str(len(samples_x.split(';'))),
+            'samples_x': samples_x, 'samples_y': samples_y,
+            'image': image_string}
+
+# Define a generator splitting the frames in chunks of chunk_size frames
+def chunked(frames, chunk_size):
+    frames = iter(frames)
+    while True:
+        chunk = list(islice(frames, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+# Define a function to observe the frames of a chunk (this is what runs in the worker processes)
+def observe_chunk(chunk, world_size=200, nearest=False, max_range=None):
+    results = []
+    for frame in chunk:
+        observation = observe_frame(load_frame(frame['path']), frame['pos'][0], frame['pos'][1], frame['yaw'], world_size, nearest,
+                                    max_range=max_range)
+        # Only the worldmap cells are needed to update the worldmap, don't send the rest back.
+        observation.threshed = None
+        results.append((frame, observation))
+    return results
+
+# Define a function to replay frames, returns the Rover holding the resulting worldmap and the number of frames
+# worldmap: options of the worldmap (see create_worldmap, None => the default one of RoverState).
+# occupancy: options of the OccupancyGrid to map with (None => hits are accumulated in the worldmap).
+# map_range: only map the pixels within this distance (meters) from the rover (None => no limit).
+# explore: keep the exploration frontier up to date (see FrontierPlanner), to measure its cost.
+def replay(frames, workers=1, chunk_size=64, nearest=False, worldmap=None, occupancy=None, map_range=None, explore=False):
+    # Imported here so the worker processes don't need the simulator server.
+    from drive_rover import RoverState
+    Rover = RoverState()
+    # The worldmap update events are meant for the simulator console.
+    Rover.events.console_level = QUIET
+    if worldmap is not None:
+        Rover.worldmap = create_worldmap(**worldmap)
+        Rover.map_stats = MapStatistics(Rover.worldmap, Rover.ground_truth)
+    if occupancy is not None:
+        Rover.occupancy = create_occupancy_grid(Rover.worldmap, **occupancy)
+    Rover.map_range = map_range
+    if explore:
+        Rover.planner = FrontierPlanner(Rover.map_stats)
+    world_size = Rover.worldmap.shape[0]
+    frame_count = 0
+    
+    chunks = chunked(frames, chunk_size)
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        if pool is not None:
+            # imap keeps the chunks in order while the next ones are being processed.
+            results = pool.imap(_observe_chunk, ((chunk, world_size, nearest, map_range) for chunk in chunks))
+        else:
+            results = (observe_chunk(chunk, world_size, nearest, map_range) for chunk in chunks)
+        
+        for chunk_results in results:
+            for frame, observation in chunk_results:
+                Rover.pos, Rover.yaw, Rover.pitch, Rover.roll = frame['pos'], frame['yaw'], frame['pitch'], frame['roll']
+                Rover.vel, Rover.throttle, Rover.brake, Rover.steer = frame['vel'], frame['throttle'], frame['brake'], frame['steer']
+                update_worldmap(Rover, observation)
+                frame_count += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return Rover, frame_count
+
+def _observe_chunk(args):
+    return observe_chunk(*args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run through the perception step')
+    parser.add_argument('log', type=str, help='Path to the robot_log.csv of the recording.')
+    parser.add_argument('--images', type=str, default=None,
+                        help='Folder of images to use instead of the Path column of the log (paired with the log lines in natural order).')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
+    parser.add_argument('--chunk-size', type=int, default=64, help='Number of frames sent to a worker at a time.')
+    parser.add_argument('--nearest', action='store_true', help='Use nearest-neighbour interpolation for the perspective transform.')
+    parser.add_argument('--world-size', type=int, default=200, help='Size (in meters/cells) of the square world to map.')
+    parser.add_argument('--tile-size', type=int, default=0,
+                        help='Store the worldmap in tiles of this size allocated as the rover explores (default: one dense map).')
+    parser.add_argument('--occupancy', action='store_true',
+                        help='Map the navigable terrain and obstacles with a log-odds occupancy grid (see OccupancyGrid).')
+    parser.add_argument('--occupancy-half-life', type=float, default=None,
+                        help='Number of frames for the evidence of a cell not observed again to fade by half (default: no decay).')
+    parser.add_argument('--map-range', type=float, default=0,
+                        help='Only map the pixels within this distance (in meters) from the rover (default: no limit).')
+    parser.add_argument('--explore', action='store_true', help='Keep the exploration frontier up to date (see FrontierPlanner).')
+    parser.add_argument('--output', type=str, default='', help='Save the worldmap image (.png/.jpg) or array (.npy).')
+    args = parser.parse_args()
+    
+    worldmap = {'world_size': args.world_size, 'tile_size': args.tile_size}
+    occupancy = {'half_life': args.occupancy_half_life} if args.occupancy else None
+    Rover, frame_count = replay(read_log(args.log, args.images), workers=args.workers, chunk_size=args.chunk_size,
+                                nearest=args.nearest, worldmap=worldmap, occupancy=occupancy,
+                                map_range=args.map_range or None, explore=args.explore)
+    if Rover.occupancy is not None:
+        Rover.occupancy.refresh(Rover.worldmap, Rover.map_stats)
+    print("Frames: {}".format(frame_count))
+    print("Mapped: {}%".format(Rover.map_stats.perc_mapped))
+    print("Fidelity: {}%".format(Rover.map_stats.fidelity))
+    if Rover.planner is not None:
+        print("Frontier: {} cells".format(len(Rover.planner.frontier)))
+    
+    if args.output.endswith('.npy'):
+        # Only the explored part of a tiled worldmap
+        if isinstance(Rover.worldmap, TiledWorldmap):
+            np.save(args.output, map_region(Rover.worldmap, *Rover.worldmap.extent()))
+        else:
+            np.save(args.output, Rover.worldmap)
+    elif args.output:
+        Rover.total_time = 0
+        map_image = np.clip(render_map(Rover), 0, 255).astype(np.uint8)
+        cv2.imwrite(args.output, cv2.cvtColor(map_image, cv2.COLOR_RGB2BGR))
@@ -0,0 +1,89 @@
+import time
+
+# Degradations of the frame processing, the default order is the order they are applied when the frame budget is at risk
+SKIP_INSETS = 'insets'     # Don't render/encode the insets, the last encoded images are sent again
+SKIP_WORLDMAP = 'worldmap' # Don't update the navigable terrain and obstacles of the worldmap (the rest of the frame state still is)
+DOWNSCALE = 'downscale'    # Run the perception on a warped image half the resolution (about 3x cheaper)
+DEGRADATIONS = (SKIP_INSETS, SKIP_WORLDMAP, DOWNSCALE)
+
+# Define a class keeping the processing of the frames within a time budget. It measures the cost of the frames
+# and of the stages which can be degraded (exponential moving averages), and applies the degradations one at a time,
+# in `order`, while the frames cost more than the budget. A degradation is lifted once the frames would fit in
+# headroom * budget with the measured cost of the stage it skips. Changes are at least `patience` frames apart,
+# so the averages reflect the current level.
+# The decision step always runs on the inputs of the current frame, whatever the level.
+class FrameScheduler():
+    def __init__(self, budget_ms=20, order=DEGRADATIONS, headroom=0.8, smoothing=0.1, patience=15, reduction=2):
+        for name in order:
+            if name not in DEGRADATIONS:
+                raise ValueError("Unknown degradation '{}' (expected some of {})".format(name, ', '.join(DEGRADATIONS)))
+        self.budget = budget_ms / 1000
+        self.order = tuple(order)
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.patience = patience
+        self.reduction = reduction # Perception resolution reduction of the downscale degradation
+        self.level = 0 # Number of degradations of `order` applied
+        self.frame_cost = None # Average cost of a frame (seconds)
+        self.stage_costs = {}  # Average cost of the stages, by name ('insets', 'worldmap', 'perception' and 'perception_reduced')
+        self.frames_since_change = 0
+        self.degraded_count = 0 # Number of frames processed with at least one degradation
+        self.frame_start = None
+    
+    # Whether a degradation is currently applied
+    def active(self, name):
+        return name in self.order[:self.level]
+    
+    # Perception resolution reduction to apply on this frame (1 => full resolution)
+    @property
+    def perception_reduction(self):
+        return self.reduction if self.active(DOWNSCALE) else 1
+    
+    def begin_frame(self):
+        self.frame_start = time.perf_counter()
+    
+    # Call a stage function, recording its cost under `stage`. Returns the result of the function.
+    def time(self, stage, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        self.add(stage, time.perf_counter() - start)
+        return result
+    
+    def add(self, stage, seconds):
+        cost = self.stage_costs.get(stage)
+        self.stage_costs[stage] = seconds if cost is None else cost + self.smoothing * (seconds - cost)
+    
+    # Record the cost of the frame and change the level if needed. Returns the new level.
+    def end_frame(self):
+        seconds = time.perf_counter() - self.frame_start
+        self.frame_cost = seconds if self.frame_cost is None else self.frame_cost + self.smoothing * (seconds - self.frame_cost)
+        if self.level > 0:
+            self.degraded_count += 1
+        self.frames_since_change += 1
+        if self.frames_since_change < self.patience:
+            return self.level
+        
+        if self.frame_cost > self.budget and self.level < len(self.order):
+            self.level += 1
+            self.frames_since_change = 0
+        elif self.level > 0 and self.frame_cost + self.restore_cost(self.order[self.level - 1]) < self.headroom * self.budget:
+            self.level -= 1
+            self.frames_since_change = 0
+        return self.level
+    
+    # Estimated cost added to a frame by lifting a degradation (0 if the stage it skips has never been measured)
+    def restore_cost(self, name):
+        if name == DOWNSCALE:
+            full, reduced = self.stage_costs.get('perception'), self.stage_costs.get('perception_reduced')
+            if full is None or reduced is None:
+                return 0
+            return max(full - reduced, 0)
+        return self.stage_costs.get(name, 0)
+    
+    def snapshot(self):
+        return {'budget_ms': self.budget * 1000,
+                'level': self.level,
+                'degradations': list(self.order[:self.level]),
+                'frame_cost_ms': self.frame_cost * 1000 if self.frame_cost is not None else None,
+                'stage_costs_ms': {stage: cost * 1000 for stage, cost in self.stage_costs.items()},
+                'degraded_frames': self.degraded_count}
@@ -0,0 +1,267 @@
+import os
+import threading
+import traceback
+import multiprocessing
+
+import numpy as np
+import eventlet.tpool
+
+from perception import perception_step, perceive, update_worldmap
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images
+from recorder import FrameRecorder
+from metrics import StageTimings
+from events import INFO
+from planner import FrontierPlanner
+from scheduler import FrameScheduler, SKIP_INSETS, SKIP_WORLDMAP
+from worldmap import create_occupancy_grid, MapStatistics, create_worldmap
+
+# Define a function to build the message carrying the commands (and inset images) sent to a simulator.
+# frame_id: the simulator doesn't send one, but a client can (see load_test.py) to match the replies with its frames.
+def control_message(commands, image_string1, image_string2, frame_id=None):
+    data={
+        'throttle': commands[0].__str__(),
+        'brake': commands[1].__str__(),
+        'steering_angle': commands[2].__str__(),
+        'inset_image1': image_string1,
+        'inset_image2': image_string2,
+        }
+    if frame_id is not None:
+        data['frame_id'] = frame_id
+    return data
+
+# Define a function to build the message of the "pickup" command
+def pickup_message(frame_id=None):
+    pickup = {}
+    if frame_id is not None:
+        pickup['frame_id'] = frame_id
+    return pickup
+
+# Define a class holding everything the server keeps for one connected simulator:
+# its rover state and, if the run is recorded, its recorder (frames saved in record_folder/<sid>).
+# worldmap: options of the worldmap (see create_worldmap, None => the default one of the state class).
+# occupancy: options of the OccupancyGrid to map with (None => hits are accumulated in the worldmap).
+# map_range: only map the pixels within this distance (meters) from the rover (None => no limit).
+# explore: steer towards the unexplored areas of the worldmap (see FrontierPlanner).
+# scheduler: options of the FrameScheduler keeping the frames within a time budget (None => every stage runs in full).
+class RoverSession():
+    def __init__(self, sid, state_class, console_level=INFO, record_folder='', record_options=None, events_dump='',
+                 worldmap=None, occupancy=None, map_range=None, explore=False, scheduler=None):
+        self.sid = sid
+        self.Rover = state_class()
+        self.Rover.events.console_level = console_level
+        if worldmap is not None:
+            self.Rover.worldmap = create_worldmap(**worldmap)
+            self.Rover.map_stats = MapStatistics(self.Rover.worldmap, self.Rover.ground_truth)
+        if occupancy is not None:
+            self.Rover.occupancy = create_occupancy_grid(self.Rover.worldmap, **occupancy)
+        self.Rover.map_range = map_range
+        if explore:
+            self.Rover.planner = FrontierPlanner(self.Rover.map_stats)
+        self.scheduler = FrameScheduler(**scheduler) if scheduler is not None else None
+        self.events_dump = events_dump # Save the events of the session there when it is closed (with the sid appended)
+        self.recorder = None
+        if record_folder:
+            self.recorder = FrameRecorder(os.path.join(record_folder, sid), **(record_options or {}))
+
+    # Process a telemetry frame: perception, decision and the reply to send.
+    # Returns the reply as an (event, data) pair, the stages are timed in metrics.
+    def step(self, data, metrics):
+        if self.scheduler is not None:
+            self.scheduler.begin_frame()
+
+        # Initialize / update Rover with current telemetry
+        Rover, image = metrics.time('update_rover', update_rover, self.Rover, data)
+        frame_id = data.get('frame_id')
+
+        if np.isfinite(Rover.vel):
+            # Execute the perception and decision steps to update the Rover's state
+            Rover = metrics.time('perception_step', self.perception, Rover)
+            Rover = metrics.time('decision_step', decision_step, Rover)
+
+            # Create output images to send to server
+            out_image_string1, out_image_string2 = metrics.time('create_output_images', self.output_images, Rover)
+
+            # If in a state where want to pickup a rock send pickup command
+            if Rover.send_pickup and not Rover.picking_up:
+                reply = ('pickup', pickup_message(frame_id))
+                # Reset Rover flags
+                Rover.send_pickup = False
+            else:
+                commands = (Rover.throttle, Rover.brake, Rover.steer)
+                reply = ('data', control_message(commands, out_image_string1, out_image_string2, frame_id))
+
+        # In case of invalid telemetry, send null commands
+        else:
+            # Send zeros for throttle, brake and steer and empty images
+            reply = ('data', control_message((0, 0, 0), '', '', frame_id))
+
+        # Queue the frame for the background recorder if a folder was specified
+        if self.recorder is not None:
+            self.recorder.record(Rover, image)
+        self.Rover = Rover
+        if self.scheduler is not None:
+            self.scheduler.end_frame()
+        return reply
+
+    # Perception step, degraded as decided by the scheduler (if any): the decision inputs are always
+    # computed from the current frame, possibly at a reduced resolution, the navigable terrain/obstacles
+    # updates of the worldmap can be skipped (the rest of the per-frame state is always updated).
+    def perception(self, Rover):
+        scheduler = self.scheduler
+        if scheduler is None:
+            return perception_step(Rover)
+        reduction = scheduler.perception_reduction
+        observation = scheduler.time('perception' if reduction == 1 else 'perception_reduced', perceive, Rover, reduction)
+        if scheduler.active(SKIP_WORLDMAP):
+            update_worldmap(Rover, observation, update_map=False)
+        else:
+            scheduler.time(SKIP_WORLDMAP, update_worldmap, Rover, observation)
+        return Rover
+
+    def output_images(self, Rover):
+        scheduler = self.scheduler
+        if scheduler is None:
+            return create_output_images(Rover)
+        if scheduler.active(SKIP_INSETS):
+            return create_output_images(Rover, render=False)
+        return scheduler.time(SKIP_INSETS, create_output_images, Rover)
+
+    # State of the scheduler and recorder of the session (reported by the /metrics route of the server)
+    def status(self):
+        status = {}
+        if self.scheduler is not None:
+            status['scheduler'] = self.scheduler.snapshot()
+        if self.recorder is not None:
+            status['recorder'] = {'recorded': self.recorder.recorded_count, 'dropped': self.recorder.dropped_count,
+                                  'written': self.recorder.written_count}
+        return status
+
+    def close(self):
+        if self.events_dump:
+            self.Rover.events.dump('{}_{}.npy'.format(os.path.splitext(self.events_dump)[0], self.sid))
+        if self.recorder is not None:
+            # Write the frames still waiting in the recorder queue
+            self.recorder.close()
+            print("Recorded {} frames of {} ({} dropped)".format(self.recorder.written_count, self.sid,
+                                                                   self.recorder.dropped_count))
+
+# Define a class running the rover sessions in `shard_count` worker processes, so several rovers
+# are processed in parallel on different cores. A session stays in the worker it has been assigned
+# to when it was opened (the one with the fewest sessions). The calls block in a thread of eventlet's
+# thread pool, so the server keeps receiving messages while the workers process the frames.
+# A worker which dies is restarted, the sessions assigned to it start again from a new rover state.
+class ShardPool():
+    def __init__(self, shard_count, session_options):
+        self.context = multiprocessing.get_context('spawn')
+        self.session_options = session_options
+        self.connections = [None] * shard_count
+        self.processes = [None] * shard_count
+        self.locks = [threading.Lock() for _ in range(shard_count)] # One request at a time on the connection of a worker
+        self.session_counts = [0] * shard_count
+        self.assignments = {} # Worker of each session, by sid
+        self.restart_count = 0
+        for shard in range(shard_count):
+            self._start_worker(shard)
+
+    def open(self, sid):
+        shard = int(np.argmin(self.session_counts))
+        self.assignments[sid] = shard
+        self.session_counts[shard] += 1
+        self._call(shard, ('open', sid, None))
+
+    # Process a telemetry frame of a session in its worker, returns the reply (see RoverSession.step).
+    # The timings of the stages of the frame are added to metrics.
+    def step(self, sid, data, metrics):
+        shard = self.assignments.get(sid)
+        if shard is None:
+            return None
+        result = self._call(shard, ('frame', sid, data))
+        if result is None:
+            return None
+        reply, timings = result
+        for stage, duration in timings:
+            metrics.add(stage, duration)
+        return reply
+
+    def close(self, sid):
+        shard = self.assignments.pop(sid, None)
+        if shard is not None:
+            self.session_counts[shard] -= 1
+            self._call(shard, ('close', sid, None))
+
+    # State of the sessions of all the workers (see RoverSession.status), by sid
+    def status(self):
+        status = {}
+        for shard in range(len(self.processes)):
+            status.update(self._call(shard, ('status', None, None)) or {})
+        return status
+
+    # Close all the sessions and stop the workers
+    def shutdown(self):
+        for shard, process in enumerate(self.processes):
+            if process.is_alive():
+                self._call(shard, ('stop', None, None))
+                process.join()
+        self.assignments.clear()
+
+    def _start_worker(self, shard):
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=_run_shard, args=(worker_connection, self.session_options), daemon=True)
+        process.start()
+        self.connections[shard] = connection
+        self.processes[shard] = process
+
+    def _call(self, shard, message):
+        return eventlet.tpool.execute(self._exchange, shard, message)
+
+    # Send a message to a worker and return its answer (None if the worker has died, it is restarted then)
+    def _exchange(self, shard, message):
+        with self.locks[shard]:
+            try:
+                self.connections[shard].send(message)
+                return self.connections[shard].recv()
+            except (EOFError, OSError):
+                self._restart_worker(shard)
+                return None
+
+    # Replace a dead worker, and open the sessions which were assigned to it in the new one
+    def _restart_worker(self, shard):
+        print("Worker {} of the rover sessions has stopped, restarting it".format(shard))
+        self.connections[shard].close()
+        self.processes[shard].join(timeout=1)
+        self._start_worker(shard)
+        self.restart_count += 1
+        for sid in [sid for sid, assigned in self.assignments.items() if assigned == shard]:
+            self.connections[shard].send(('open', sid, None))
+            self.connections[shard].recv()
+
+def _run_shard(connection, session_options):
+    sessions = {}
+    timings = StageTimings() # Sent back with the replies, the server adds them to its metrics
+    while True:
+        kind, sid, data = connection.recv()
+        if kind == 'stop':
+            for session in sessions.values():
+                session.close()
+            connection.send(None)
+            return
+
+        # An invalid frame (or a bug) only loses the answer of this message, not the worker and its sessions
+        answer = None
+        try:
+            if kind == 'frame':
+                session = sessions.get(sid)
+                answer = (session.step(data, timings), timings.drain()) if session is not None else None
+            elif kind == 'open':
+                sessions[sid] = RoverSession(sid, **session_options)
+            elif kind == 'close':
+                session = sessions.pop(sid, None)
+                if session is not None:
+                    session.close()
+            elif kind == 'status':
+                answer = {sid: session.status() for sid, session in sessions.items()}
+        except Exception:
+            traceback.print_exc()
+            timings.drain()
+        connection.send(answer)
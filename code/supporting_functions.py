@@ -5,6 +5,8 @@ from io import BytesIO, StringIO
 import base64
 import time
 
+from worldmap import SampleLocator, map_region
+
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
     if ',' in string_to_convert:
@@ -14,6 +16,47 @@ def convert_to_float(string_to_convert):
     return float_value
 
 
+# Define a class holding a camera frame as received from the simulator (JPEG bytes).
+# The PIL image is only built when it is needed (to save the frame while recording).
+class CameraFrame():
+    def __init__(self, jpeg_bytes):
+        self.jpeg_bytes = jpeg_bytes
+        self._image = None
+    
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.open(BytesIO(self.jpeg_bytes))
+        return self._image
+    
+    def save(self, filename):
+        self.image.save(filename)
+
+# Define a class to decode the camera frames into a reusable RGB buffer.
+# reduction: decode the image at 1/1, 1/2, 1/4 or 1/8 of its resolution (JPEG DCT scaling, much cheaper).
+class FrameDecoder():
+    READ_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+    
+    def __init__(self, reduction=1):
+        if reduction not in self.READ_FLAGS:
+            raise ValueError("reduction must be one of {}".format(sorted(self.READ_FLAGS)))
+        self.reduction = reduction
+        self.rgb_buffer = None
+    
+    # Decode a base64 JPEG string. Returns the RGB image (the buffer is reused by the next decode) and the frame.
+    def decode(self, img_string):
+        frame = CameraFrame(base64.b64decode(img_string))
+        bgr = cv2.imdecode(np.frombuffer(frame.jpeg_bytes, dtype=np.uint8), self.READ_FLAGS[self.reduction])
+        if bgr is None:
+            raise ValueError("Invalid camera image")
+        
+        if self.rgb_buffer is None or self.rgb_buffer.shape != bgr.shape:
+            self.rgb_buffer = np.empty(bgr.shape, dtype=np.uint8)
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self.rgb_buffer)
+        return self.rgb_buffer, frame
+
+
 def update_rover(Rover, data):
     # Initialize start time and sample positions
     if Rover.start_time == None:
@@ -24,6 +67,7 @@ def update_rover(Rover, data):
         samples_ypos = np.int_([convert_to_float(pos.strip())
                                 for pos in data["samples_y"].split(';')])
         Rover.samples_pos = (samples_xpos, samples_ypos)
+        Rover.sample_locator = SampleLocator(samples_xpos, samples_ypos, Rover.worldmap.shape[1])
         Rover.samples_to_find = int(data["sample_count"])
     # Or just update elapsed time
     else:
@@ -60,76 +104,109 @@ def update_rover(Rover, data):
     #       'samples collected:', Rover.samples_collected)
     # Get the current image from the center camera of the rover
     imgString = data["image"]
-    image = Image.open(BytesIO(base64.b64decode(imgString)))
-    Rover.img = np.asarray(image)
+    Rover.img, image = Rover.frame_decoder.decode(imgString)
 
     # Return updated Rover and separate image for optional saving
     return Rover, image
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
+# Define a class to encode an inset image (RGB) sent to the simulator as a base64 JPEG string.
+# The conversion buffers are reused between frames, the encoding can be rate limited
+# and it is skipped when the image hasn't changed since the last encode.
+class InsetEncoder():
+    def __init__(self, quality=75, max_rate=None):
+        self.quality = quality   # JPEG quality (0 to 100)
+        self.max_rate = max_rate # Maximum number of refreshes per second (None => every frame)
+        self.last_string = ''    # Last encoded image
+        self.last_time = None    # Time of the last refresh
+        self.encoded_count = 0   # Number of images actually encoded
+        self.skipped_count = 0   # Number of refreshes skipped because the image hadn't changed
+        
+        self.uint8_buffer = None  # The image converted to uint8
+        self.bgr_buffer = None    # The image converted to BGR (cv2 channel order)
+        self.last_image = None    # Copy of the last encoded image
+    
+    # Check whether the inset should be refreshed on this frame.
+    def due(self):
+        if self.max_rate is None or self.last_time is None:
+            return True
+        return time.monotonic() - self.last_time >= 1 / self.max_rate
+    
+    def encode(self, img):
+        self.last_time = time.monotonic()
+        
+        if img.dtype != np.uint8:
+            if self.uint8_buffer is None or self.uint8_buffer.shape != img.shape:
+                self.uint8_buffer = np.empty(img.shape, dtype=np.uint8)
+            # Same conversion as img.astype(np.uint8), without allocating a new image.
+            np.copyto(self.uint8_buffer, img, casting='unsafe')
+            img = self.uint8_buffer
+        
+        # Nothing to do if the image is the same as the last encoded one.
+        if self.last_image is not None and self.last_image.shape == img.shape and np.array_equal(self.last_image, img):
+            self.skipped_count += 1
+            return self.last_string
+        
+        if self.bgr_buffer is None or self.bgr_buffer.shape != img.shape:
+            self.bgr_buffer = np.empty(img.shape, dtype=np.uint8)
+        cv2.cvtColor(img, cv2.COLOR_RGB2BGR, dst=self.bgr_buffer)
+        _, jpeg = cv2.imencode('.jpg', self.bgr_buffer, [int(cv2.IMWRITE_JPEG_QUALITY), int(self.quality)])
+        self.last_string = base64.b64encode(jpeg).decode("utf-8")
+        
+        if self.last_image is None or self.last_image.shape != img.shape:
+            self.last_image = img.copy()
+        else:
+            np.copyto(self.last_image, img)
+        self.encoded_count += 1
+        return self.last_string
 
+# Define a function to render the worldmap inset (worldmap over the ground truth map, with statistics)
+def render_map(Rover):
+
+    # Apply the pending decay of the occupancy grid (if any) to the worldmap
+    if Rover.occupancy is not None:
+        Rover.occupancy.refresh(Rover.worldmap, Rover.map_stats)
+    
+    # The displayed part of the worldmap is the area of the ground truth map
+    worldmap = map_region(Rover.worldmap, *Rover.ground_truth.shape[:2])
+    
     # Create a scaled map for plotting and clean up obs/nav pixels a bit
-    if np.max(Rover.worldmap[:, :, 2]) > 0:
-        nav_pix = Rover.worldmap[:, :, 2] > 0
-        navigable = Rover.worldmap[:, :, 2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
+    # The channel means are kept up to date by perception_step in Rover.map_stats
+    stats = Rover.map_stats
+    if stats.nonzero_pix[2] > 0:
+        navigable = worldmap[:, :, 2] * (255 / stats.channel_mean(2))
     else:
-        navigable = Rover.worldmap[:, :, 2]
-    if np.max(Rover.worldmap[:, :, 0]) > 0:
-        obs_pix = Rover.worldmap[:, :, 0] > 0
-        obstacle = Rover.worldmap[:, :, 0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
+        navigable = worldmap[:, :, 2]
+    if stats.nonzero_pix[0] > 0:
+        obstacle = worldmap[:, :, 0] * (255 / stats.channel_mean(0))
     else:
-        obstacle = Rover.worldmap[:, :, 0]
+        obstacle = worldmap[:, :, 0]
 
     likely_nav = navigable >= obstacle
     obstacle[likely_nav] = 0
-    plotmap = np.zeros_like(Rover.worldmap)
+    plotmap = np.zeros(worldmap.shape, dtype=float)
     plotmap[:, :, 0] = obstacle
     plotmap[:, :, 2] = navigable
     plotmap = plotmap.clip(0, 255)
     # Overlay obstacle and navigable terrain map with ground truth map
-    map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
+    map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0, dtype=cv2.CV_64F)
 
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:, :, 1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
+    # Plot the location of the known samples which have been located on the map
+    # (rock detections within 3 meters, kept up to date by perception_step)
     samples_located = 0
-    if rock_world_pos[0].any():
+    if Rover.sample_locator is not None:
         rock_size = 2
-        if len(Rover.samples_pos):
-            for idx in range(len(Rover.samples_pos[0])):
-                test_rock_x = Rover.samples_pos[0][idx]
-                test_rock_y = Rover.samples_pos[1][idx]
-                rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 +
-                                            (test_rock_y - rock_world_pos[0])**2)
-                # If rocks were detected within 3 meters of known sample positions
-                # consider it a success and plot the location of the known
-                # sample on the map
-                if np.min(rock_sample_dists) < 3:
-                    samples_located += 1
-                    map_add[test_rock_y-rock_size:test_rock_y+rock_size,
-                            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-    # Calculate some statistics on the map results
-    # First get the total number of pixels in the navigable terrain map
-    tot_nav_pix = float(len((plotmap[:, :, 2].nonzero()[0])))
-    # Next figure out how many of those correspond to ground truth pixels
-    good_nav_pix = float(
-        len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] > 0)).nonzero()[0]))
-    # Next find how many do not correspond to ground truth pixels
-    bad_nav_pix = float(
-        len(((plotmap[:, :, 2] > 0) & (Rover.ground_truth[:, :, 1] == 0)).nonzero()[0]))
-    # Grab the total number of map pixels
-    tot_map_pix = float(len((Rover.ground_truth[:, :, 1].nonzero()[0])))
-    # Calculate the percentage of ground truth map that has been successfully found
-    perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-    # Calculate the number of good map pixel detections divided by total pixels
-    # found to be navigable terrain
-    if tot_nav_pix > 0:
-        fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-    else:
-        fidelity = 0
+        for idx in np.flatnonzero(Rover.sample_locator.located):
+            test_rock_x = Rover.samples_pos[0][idx]
+            test_rock_y = Rover.samples_pos[1][idx]
+            samples_located += 1
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size,
+                    test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
+    # Statistics on the map results (kept up to date by perception_step)
+    # Percentage of ground truth map that has been successfully found
+    perc_mapped = stats.perc_mapped
+    # Number of good map pixel detections divided by total pixels found to be navigable terrain
+    fidelity = stats.fidelity
     # Flip the map for plotting so that the y-axis points upward in the display
     map_add = np.flipud(map_add).astype(np.float32)
     # Add some text about map and rock sample detection results
@@ -145,15 +222,25 @@ def create_output_images(Rover):
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
     cv2.putText(map_add, "  Collected: "+str(Rover.samples_collected), (0, 85),
                 cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-    # Convert map and vision image to base64 strings for sending to server
-    pil_img = Image.fromarray(map_add.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    return map_add
+
+# Define a function to create display output given worldmap results
+# render: False => don't render any inset on this frame (to save time), send the last encoded ones again.
+def create_output_images(Rover, render=True):
+    if not render:
+        return Rover.map_inset.last_string, Rover.vision_inset.last_string
     
-    pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
-    buff = BytesIO()
-    pil_img.save(buff, format="JPEG")
-    encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
+    # Convert map and vision image to base64 strings for sending to server.
+    # Each inset is only rendered/encoded when its encoder is due for a refresh,
+    # otherwise the last encoded image is sent again with the commands.
+    if Rover.map_inset.due():
+        encoded_string1 = Rover.map_inset.encode(render_map(Rover))
+    else:
+        encoded_string1 = Rover.map_inset.last_string
+    
+    if Rover.vision_inset.due():
+        encoded_string2 = Rover.vision_inset.encode(Rover.vision_image)
+    else:
+        encoded_string2 = Rover.vision_inset.last_string
 
     return encoded_string1, encoded_string2
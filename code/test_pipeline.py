@@ -0,0 +1,36 @@
+import time
+
+import eventlet
+
+from pipeline import FramePipeline
+
+# Flood a pipeline whose processing is slower than the frame rate: the frames arriving while a frame is
+# processed must replace each other (latest frame wins), and the last frame must be the last one processed.
+# $ python -m pytest -q test_pipeline.py
+def test_pipeline_drops_stale_frames():
+    processed = []
+    replies = []
+
+    def process_frame(sid, data):
+        time.sleep(0.02) # Slow (blocking) processing
+        processed.append(data)
+        return data
+
+    pipeline = FramePipeline(process_frame, lambda sid, reply: replies.append(reply)).start()
+    try:
+        frame_count = 200
+        for frame in range(frame_count):
+            pipeline.submit('sid', frame)
+            eventlet.sleep(0.001) # About 1000 fps, like the socket handler receiving frames
+        # Wait for the last frame
+        deadline = time.monotonic() + 5
+        while pipeline.processed_count + pipeline.dropped_count < frame_count and time.monotonic() < deadline:
+            eventlet.sleep(0.01)
+    finally:
+        pipeline.stop()
+
+    assert pipeline.dropped_count > 0
+    assert pipeline.processed_count + pipeline.dropped_count == frame_count
+    assert processed[-1] == frame_count - 1
+    assert processed == sorted(processed)
+    assert replies == processed
@@ -0,0 +1,415 @@
+import numpy as np
+
+# Worldmap channels: 0 => obstacles, 1 => rock samples, 2 => navigable terrain.
+# The map is stored as unsigned integers, every channel saturates at its own maximum value
+# (the obstacles channel keeps counting hits, the other ones are display values).
+WORLDMAP_DTYPE = np.uint16
+CHANNEL_MAX = (np.iinfo(WORLDMAP_DTYPE).max, 255, 255)
+
+# Define a function to create an empty worldmap: a dense (world_size, world_size, 3) array,
+# or with a tile_size, a TiledWorldmap (for worlds too large to be held densely).
+def create_worldmap(world_size=200, tile_size=None):
+    if tile_size:
+        return TiledWorldmap(world_size, tile_size)
+    return np.zeros((world_size, world_size, 3), dtype=WORLDMAP_DTYPE)
+
+# Define a class holding a worldmap of world_size x world_size cells split in tile_size x tile_size tiles,
+# only allocated once one of their cells is written, so the memory and the cost of the whole map operations
+# grow with the explored area instead of the size of the world.
+# The cells are addressed like the cells of a dense worldmap (flat indices y * world_size + x), and the
+# functions below (read_cells, write_cells, add_hits, set_masked, map_values...) accept both kinds of worldmaps.
+# The tiles are stored one after the other in a growing array, in their allocation order.
+# channels, dtype: the cell values (the ones of a worldmap by default, see OccupancyGrid for another use).
+class TiledWorldmap():
+    def __init__(self, world_size=2048, tile_size=64, channels=3, dtype=WORLDMAP_DTYPE):
+        if world_size % tile_size:
+            raise ValueError("The world size ({}) must be a multiple of the tile size ({})".format(world_size, tile_size))
+        self.shape = (world_size, world_size, channels)
+        self.dtype = np.dtype(dtype)
+        self.tile_size = tile_size
+        self.tiles_per_row = world_size // tile_size
+        # Slot of each tile in self.data (-1 => not allocated), by tile index (tile_y * tiles_per_row + tile_x)
+        self.slots = np.full(self.tiles_per_row * self.tiles_per_row, -1, dtype=np.int32)
+        self.tile_indices = np.zeros(16, dtype=np.int64) # Tile index of each slot
+        self.data = np.zeros((16, tile_size * tile_size, channels), dtype=self.dtype)
+        self.tile_count = 0
+        self._cells = None # Flat indices of the cells of the allocated tiles (see cells())
+        
+        # Offset of the flat index of each cell of a tile from the flat index of its first cell
+        tile_y, tile_x = np.divmod(np.arange(tile_size * tile_size), tile_size)
+        self.tile_offsets = tile_y * world_size + tile_x
+    
+    @property
+    def nbytes(self):
+        return self.data[:self.tile_count].nbytes
+    
+    # Tile index and position in their tile of the cells at the given flat indices
+    def locate(self, cells):
+        cell_y, cell_x = np.divmod(np.asarray(cells, dtype=np.intp), self.shape[1])
+        tile_y, y = np.divmod(cell_y, self.tile_size)
+        tile_x, x = np.divmod(cell_x, self.tile_size)
+        return tile_y * self.tiles_per_row + tile_x, y * self.tile_size + x
+    
+    # Values of a channel at the given flat cell indices (0 in the tiles not allocated)
+    def read(self, channel, cells):
+        tiles, positions = self.locate(cells)
+        slots = self.slots[tiles]
+        allocated = slots >= 0
+        if allocated.all():
+            return self.data[slots, positions, channel]
+        values = np.zeros(len(slots), dtype=self.dtype)
+        values[allocated] = self.data[slots[allocated], positions[allocated], channel]
+        return values
+    
+    # Write values of a channel at the given flat cell indices, allocating their tiles if needed
+    def write(self, channel, cells, values):
+        tiles, positions = self.locate(cells)
+        slots = self.slots[tiles]
+        if (slots < 0).any():
+            self.allocate(np.unique(tiles[slots < 0]))
+            slots = self.slots[tiles]
+        self.data[slots, positions, channel] = values
+    
+    def allocate(self, tiles):
+        count = self.tile_count + len(tiles)
+        if count > len(self.data):
+            # Double the capacity, so the tiles are copied O(1) times on average
+            capacity = max(count, 2 * len(self.data))
+            data = np.zeros((capacity,) + self.data.shape[1:], dtype=self.dtype)
+            data[:self.tile_count] = self.data[:self.tile_count]
+            self.data = data
+            self.tile_indices = np.resize(self.tile_indices, capacity)
+        self.slots[tiles] = np.arange(self.tile_count, count)
+        self.tile_indices[self.tile_count:count] = tiles
+        self.tile_count = count
+        self._cells = None
+    
+    # (cells, channels) array of the values of the cells of the allocated tiles (a view, in the order of cells())
+    def values(self):
+        return self.data[:self.tile_count].reshape(-1, self.shape[2])
+    
+    # Flat indices of the cells of the allocated tiles
+    def cells(self):
+        if self._cells is None:
+            tile_y, tile_x = np.divmod(self.tile_indices[:self.tile_count], self.tiles_per_row)
+            first_cells = tile_y * self.tile_size * self.shape[1] + tile_x * self.tile_size
+            self._cells = (first_cells[:, np.newaxis] + self.tile_offsets).ravel()
+        return self._cells
+    
+    # Dense (height, width, channels) copy of the cells of the map with 0 <= y < height and 0 <= x < width
+    def region(self, height, width):
+        region = np.zeros((height, width, self.shape[2]), dtype=self.dtype)
+        tile_size = self.tile_size
+        for slot, tile in enumerate(self.tile_indices[:self.tile_count].tolist()):
+            y0, x0 = (tile // self.tiles_per_row) * tile_size, (tile % self.tiles_per_row) * tile_size
+            if y0 >= height or x0 >= width:
+                continue
+            tile_height, tile_width = min(tile_size, height - y0), min(tile_size, width - x0)
+            tile_data = self.data[slot].reshape(tile_size, tile_size, self.shape[2])
+            region[y0:y0 + tile_height, x0:x0 + tile_width] = tile_data[:tile_height, :tile_width]
+        return region
+    
+    # (height, width) of the smallest region holding all the allocated tiles
+    def extent(self):
+        if self.tile_count == 0:
+            return 0, 0
+        tile_y, tile_x = np.divmod(self.tile_indices[:self.tile_count], self.tiles_per_row)
+        return int(tile_y.max() + 1) * self.tile_size, int(tile_x.max() + 1) * self.tile_size
+
+# Define a function to read a channel of a (dense or tiled) worldmap at the given flat cell indices
+def read_cells(worldmap, channel, cells):
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.read(channel, cells)
+    return worldmap.reshape(-1, 3)[cells, channel]
+
+# Define a function to get the (cells, 3) array of the values of the cells a worldmap holds:
+# all the cells of a dense worldmap, the cells of the allocated tiles of a TiledWorldmap (see map_cells).
+# It is a view, and a boolean mask of its cells can be given to set_masked.
+def map_values(worldmap):
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.values()
+    return worldmap.reshape(-1, 3)
+
+# Define a function to get the flat indices of the cells of map_values(worldmap)
+def map_cells(worldmap):
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.cells()
+    return np.arange(worldmap.shape[0] * worldmap.shape[1])
+
+# Define a function to get a dense (height, width, 3) array of the cells of a worldmap with 0 <= y < height and
+# 0 <= x < width (a view of a dense worldmap, to be displayed or saved).
+def map_region(worldmap, height, width):
+    if isinstance(worldmap, TiledWorldmap):
+        return worldmap.region(height, width)
+    return worldmap[:height, :width]
+
+# Define a function to get the distinct cells (flat indices) hit at (x_world, y_world) and their number of hits
+def count_hits(worldmap_shape, x_world, y_world):
+    return np.unique(np.asarray(y_world, dtype=np.intp) * worldmap_shape[1] + np.asarray(x_world, dtype=np.intp),
+                     return_counts=True)
+
+# Define a class that keeps the statistics displayed with the worldmap (Mapped %, Fidelity and the
+# mean value of each channel) up to date from the cells that change, instead of scanning the whole map.
+# The ground truth map covers the cells with 0 <= y < its height and 0 <= x < its width.
+class MapStatistics():
+    def __init__(self, worldmap, ground_truth):
+        # Ground truth map pixels are the nonzero pixels of its green channel.
+        self.ground_truth = np.ascontiguousarray(ground_truth[:, :, 1]).ravel() > 0
+        self.truth_shape = ground_truth.shape[:2]
+        self.world_width = worldmap.shape[1]
+        self.same_shape = tuple(self.truth_shape) == tuple(worldmap.shape[:2]) # The ground truth covers the whole world
+        self.tot_map_pix = int(np.count_nonzero(self.ground_truth))
+        # Cells whose navigable terrain/obstacles channels became zero or nonzero (a list of arrays),
+        # only recorded when it is not None (see FrontierPlanner)
+        self.changed_cells = None
+        self.rebuild(worldmap)
+    
+    # Recompute all the statistics from the whole worldmap.
+    def rebuild(self, worldmap):
+        flat_map = map_values(worldmap)
+        self.nonzero_pix = np.count_nonzero(flat_map, axis=0).astype(np.int64)
+        self.channel_sum = flat_map.sum(axis=0, dtype=np.int64)
+        self.good_nav_pix = int(np.count_nonzero((flat_map[:, 2] > 0) & self.truth(map_cells(worldmap))))
+    
+    # Whether the cells at the given flat indices are ground truth map pixels.
+    def truth(self, cells):
+        if self.same_shape:
+            return self.ground_truth[cells]
+        cell_y, cell_x = np.divmod(np.asarray(cells, dtype=np.intp), self.world_width)
+        inside = (cell_y < self.truth_shape[0]) & (cell_x < self.truth_shape[1])
+        truth = np.zeros(len(inside), dtype=bool)
+        truth[inside] = self.ground_truth[cell_y[inside] * self.truth_shape[1] + cell_x[inside]]
+        return truth
+    
+    # Update the statistics of a channel given the values of the changed cells before and after the change.
+    def update(self, channel, cells, old_values, new_values):
+        old_values = old_values.astype(np.int64)
+        new_values = new_values.astype(np.int64)
+        self.channel_sum[channel] += int(new_values.sum() - old_values.sum())
+        became_nonzero = (old_values == 0) & (new_values > 0)
+        became_zero = (old_values > 0) & (new_values == 0)
+        self.nonzero_pix[channel] += int(np.count_nonzero(became_nonzero)) - int(np.count_nonzero(became_zero))
+        if self.changed_cells is not None and channel != 1:
+            self.changed_cells.append(np.asarray(cells)[became_nonzero | became_zero])
+        if channel == 2:
+            truth = self.truth(cells)
+            self.good_nav_pix += int(np.count_nonzero(became_nonzero & truth)) - int(np.count_nonzero(became_zero & truth))
+    
+    # Mean value of the nonzero cells of a channel (0 if there are none).
+    def channel_mean(self, channel):
+        if self.nonzero_pix[channel] == 0:
+            return 0
+        return self.channel_sum[channel] / self.nonzero_pix[channel]
+    
+    @property
+    def tot_nav_pix(self):
+        return int(self.nonzero_pix[2])
+    
+    @property
+    def bad_nav_pix(self):
+        return self.tot_nav_pix - self.good_nav_pix
+    
+    # Percentage of the ground truth map that has been successfully found.
+    @property
+    def perc_mapped(self):
+        return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+    
+    # Number of good map pixel detections divided by total pixels found to be navigable terrain.
+    @property
+    def fidelity(self):
+        if self.tot_nav_pix > 0:
+            return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+        return 0
+
+# Define a function to write new values of a channel at the given flat cell indices (all distinct),
+# keeping the map statistics (if given) up to date.
+def write_cells(worldmap, channel, cells, values, stats=None):
+    if isinstance(worldmap, TiledWorldmap):
+        old_values = worldmap.read(channel, cells) if stats is not None else None
+        worldmap.write(channel, cells, values)
+        if stats is not None:
+            stats.update(channel, cells, old_values, worldmap.read(channel, cells))
+        return cells
+    
+    # (height, width, 3) => (height*width, 3) is a view, so writing to it updates the worldmap.
+    flat_map = worldmap.reshape(-1, 3)
+    if stats is not None:
+        old_values = flat_map[cells, channel]
+        flat_map[cells, channel] = values
+        stats.update(channel, cells, old_values, flat_map[cells, channel])
+    else:
+        flat_map[cells, channel] = values
+    return cells
+
+# Define a function to add `increment` times the number of hits to a worldmap channel at the given
+# flat cell indices (all distinct), clamping the touched cells to the channel maximum.
+def add_hits(worldmap, channel, cells, hits, increment, max_value=None, stats=None):
+    if max_value is None:
+        max_value = CHANNEL_MAX[channel]
+    if len(cells) == 0:
+        return cells
+    
+    values = read_cells(worldmap, channel, cells).astype(np.int64) + hits * int(increment)
+    return write_cells(worldmap, channel, cells, np.clip(values, 0, max_value), stats)
+
+# Define a function to set a worldmap channel to `value` where `mask` is True. The mask is a boolean array
+# over the cells of map_values(worldmap) (a (height, width) array also works for a dense worldmap).
+# Returns the flat indices of the touched cells.
+def set_masked(worldmap, channel, mask, value, stats=None):
+    cells = np.flatnonzero(mask)
+    if isinstance(worldmap, TiledWorldmap):
+        cells = worldmap.cells()[cells]
+    return write_cells(worldmap, channel, cells, value, stats)
+
+# Define a class holding an occupancy grid of the navigable terrain / obstacles, an alternative to
+# accumulating hits in the worldmap channels. Each cell keeps the log-odds of being navigable terrain:
+# a cell seen as navigable terrain on a frame gets evidence for it, a cell seen as an obstacle against it
+# (once per frame, whatever the number of pixels landing on the cell), clamped to +/- limit.
+# Only the cells observed on a frame are updated, and their worldmap channels (navigable terrain and
+# obstacles, with a value proportional to the probability) are written from their log-odds.
+# With a half_life (in frames), the evidence of a cell fades towards unknown when it isn't observed:
+# each cell keeps the frame of its last update, and the decay is applied lazily when the cell is updated
+# again. The displayed values of the fading cells are refreshed from their decayed log-odds (see refresh),
+# and a cell whose evidence has faded below the display threshold (not observed for a half life at least)
+# is reset to unknown, so only the cells observed in the last few half lives are refreshed.
+# With a tile_size, the log-odds and stamps are stored in tiles allocated as the cells are observed
+# (like a TiledWorldmap), so a large world only costs the memory of its explored area.
+class OccupancyGrid():
+    def __init__(self, world_size=200, nav_increment=0.85, obs_increment=0.2, limit=6.0, threshold=1.0, half_life=None,
+                 tile_size=None):
+        self.shape = (world_size, world_size)
+        self.nav_increment = nav_increment # Log-odds added to a cell seen as navigable terrain
+        self.obs_increment = obs_increment # Log-odds removed from a cell seen as an obstacle
+        self.limit = limit                 # Maximum absolute log-odds of a cell
+        self.threshold = threshold         # Minimum absolute log-odds to show a cell as navigable terrain/obstacle
+        self.half_life = half_life         # Number of frames for the evidence of a cell to fade by half (None => no decay)
+        if tile_size:
+            self.log_odds = TiledWorldmap(world_size, tile_size, channels=1, dtype=np.float32)
+            self.stamps = TiledWorldmap(world_size, tile_size, channels=1, dtype=np.int32)
+        else:
+            self.log_odds = np.zeros(world_size * world_size, dtype=np.float32)
+            self.stamps = np.zeros(world_size * world_size, dtype=np.int32) # Frame of the last update of each cell
+        self.frame = 0 # Frame number of the decay clock (see tick)
+        self.touched = [] # Cells updated on the current frame
+        self.fading = set() # Flat indices of the cells with nonzero log-odds (only kept with a half_life)
+        self.fading_array = None # Sorted array of the fading cells (None => to be rebuilt from the set)
+    
+    # Values of the log-odds or stamps at the given flat cell indices
+    def read(self, array, cells):
+        if isinstance(array, TiledWorldmap):
+            return array.read(0, cells)
+        return array[cells]
+    
+    def write(self, array, cells, values):
+        if isinstance(array, TiledWorldmap):
+            array.write(0, cells, values)
+        else:
+            array[cells] = values
+    
+    # Log-odds of the cells at the given flat indices, with the decay since their last update applied
+    def decayed(self, cells):
+        if self.half_life is None:
+            return self.read(self.log_odds, cells)
+        ages = self.frame - self.read(self.stamps, cells)
+        return self.read(self.log_odds, cells) * np.exp2(-ages / self.half_life).astype(np.float32)
+    
+    # Add `increment` log-odds at the given flat cell indices (all distinct)
+    def add_evidence(self, cells, increment):
+        if len(cells) == 0:
+            return
+        self.write(self.log_odds, cells, np.clip(self.decayed(cells) + np.float32(increment), -self.limit, self.limit))
+        self.write(self.stamps, cells, self.frame)
+        self.touched.append(cells)
+        if self.half_life is not None:
+            self.fading.update(cells.tolist())
+            self.fading_array = None
+    
+    # Values of the obstacles and navigable terrain worldmap channels of the cells with the given log-odds
+    def channel_values(self, log_odds):
+        probability = 1 / (1 + np.exp(-log_odds))
+        navigable = np.where(log_odds >= self.threshold, np.rint(255 * probability), 0)
+        obstacle = np.where(log_odds <= -self.threshold, np.rint(255 * (1 - probability)), 0)
+        return obstacle, navigable
+    
+    # Write the worldmap channels of the cells updated on this frame.
+    def flush(self, worldmap, stats=None):
+        if self.touched:
+            cells = np.unique(np.concatenate(self.touched))
+            obstacle, navigable = self.channel_values(self.read(self.log_odds, cells))
+            write_cells(worldmap, 0, cells, obstacle, stats)
+            write_cells(worldmap, 2, cells, navigable, stats)
+            self.touched = []
+    
+    # Start the next frame (call it on every frame, whether the grid has been updated or not, so the evidence keeps fading).
+    def tick(self):
+        self.frame += 1
+    
+    # Write the worldmap channels of the fading cells whose displayed values have changed with the decay
+    # (only needed with a half_life, call it before reading the whole worldmap). The log-odds aren't updated
+    # (the decay stays lazy), except for the cells faded below the display threshold, which are reset to unknown.
+    def refresh(self, worldmap, stats=None):
+        if self.half_life is None or not self.fading:
+            return
+        if self.fading_array is None:
+            self.fading_array = np.fromiter(self.fading, dtype=np.intp, count=len(self.fading))
+        cells = self.fading_array
+        log_odds = self.decayed(cells)
+        obstacle, navigable = self.channel_values(log_odds)
+        changed = (read_cells(worldmap, 0, cells) != obstacle) | (read_cells(worldmap, 2, cells) != navigable)
+        write_cells(worldmap, 0, cells[changed], obstacle[changed], stats)
+        write_cells(worldmap, 2, cells[changed], navigable[changed], stats)
+        
+        # The cells faded below the display threshold and not observed for a half life are reset to unknown
+        # (the more recent ones may still be accumulating evidence)
+        ages = self.frame - self.read(self.stamps, cells)
+        faded = cells[(np.abs(log_odds) < self.threshold) & (ages >= self.half_life)]
+        if len(faded):
+            self.write(self.log_odds, faded, 0)
+            self.fading.difference_update(faded.tolist())
+            self.fading_array = None
+
+# Define a function to create the occupancy grid of a worldmap, tiled like the worldmap if it is a TiledWorldmap
+def create_occupancy_grid(worldmap, **options):
+    tile_size = worldmap.tile_size if isinstance(worldmap, TiledWorldmap) else None
+    return OccupancyGrid(worldmap.shape[0], tile_size=tile_size, **options)
+
+# Define a class that keeps track of which known sample positions have been located on the worldmap.
+# A sample is located once a rock cell is mapped within `radius` of it. The samples are bucketed in a
+# grid of `radius` sized cells, so a rock cell only needs to be checked against the samples of the
+# 3x3 buckets around it, and since rock cells are never cleared, each new rock cell is checked only once.
+class SampleLocator():
+    def __init__(self, samples_x, samples_y, world_width, radius=3):
+        self.samples_x = np.int_(samples_x)
+        self.samples_y = np.int_(samples_y)
+        self.world_width = world_width
+        self.radius = radius
+        self.located = np.zeros(len(self.samples_x), dtype=bool)
+        
+        self.buckets = {}
+        for idx, (x, y) in enumerate(zip(self.samples_x.tolist(), self.samples_y.tolist())):
+            self.buckets.setdefault((x // radius, y // radius), []).append(idx)
+    
+    @property
+    def located_count(self):
+        return int(np.count_nonzero(self.located))
+    
+    # Check the rock cells (flat worldmap indices) written this frame against the samples near them.
+    def add_rock_cells(self, cells):
+        if len(cells) == 0 or self.located.all():
+            return
+        rock_y, rock_x = np.divmod(np.asarray(cells), self.world_width)
+        
+        # Samples of the buckets around the rock cells which have not been located yet.
+        candidates = set()
+        for bucket_x, bucket_y in set(zip((rock_x // self.radius).tolist(), (rock_y // self.radius).tolist())):
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    candidates.update(self.buckets.get((bucket_x + dx, bucket_y + dy), ()))
+        
+        for idx in candidates:
+            if self.located[idx]:
+                continue
+            rock_sample_dists = np.sqrt((self.samples_x[idx] - rock_x)**2 + (self.samples_y[idx] - rock_y)**2)
+            # If rocks were detected within 3 meters of known sample positions consider it a success
+            if np.min(rock_sample_dists) < self.radius:
+                self.located[idx] = True